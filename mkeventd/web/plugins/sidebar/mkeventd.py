@@ -52,10 +52,13 @@ def render_mkeventd_performance():
           (_("Rule tries"),          "rule_trie", "%.2f/s"),
           (_("Created events"),      "event",     "%.2f/s"),
           (_("Client connects"),     "connect",   "%.2f/s"),
+          (_("Queue overflows"),     "overflow",  "%.2f/s"),
     ]
     for what, col, format in columns:
         write_line(what, format % data["status_average_%s_rate" % col])
 
+    write_line(_("Queued messages"), "%d" % data["status_queue_length"])
+
     # Hit rate
     try:
         write_line(_("Rule hit ratio"), "%.2f %%" % (
@@ -2288,6 +2288,27 @@ if mkeventd_enabled:
         domain = "mkeventd",
     )
 
+    register_configvar(group,
+        "status_journal",
+        Optional(
+            Age(title = _("Interval between two complete saves of the state"),
+                default_value = 3600,
+            ),
+            title = _("Save state changes into a journal"),
+            help = _("Per default the event daemon saves its complete state in each state retention "
+                     "interval. With many current events this can take a considerable amount of "
+                     "time, during which no messages are processed. With this option only the "
+                     "events that have been created, changed or deleted since the last save are "
+                     "appended to a journal file. The complete state is saved only in the "
+                     "configured interval, when the journal has grown larger than the "
+                     "complete state and when the event daemon is stopped. When starting, "
+                     "the event daemon loads the complete state and applies the journal."),
+            label = _("Save changes of the state into a journal"),
+            none_label = _("complete state is saved in each interval"),
+        ),
+        domain = "mkeventd",
+    )
+
     register_configvar(group,
         "housekeeping_interval",
         Age(title = _("Housekeeping Interval"),
@@ -2476,6 +2497,44 @@ if mkeventd_enabled:
         domain = "mkeventd",
     )
 
+    register_configvar(group,
+        "event_pipeline",
+        Optional(
+            Tuple(
+                elements = [
+                    Integer(
+                        title = _("Maximum number of queued messages"),
+                        help = _("Syslog messages via UDP and SNMP traps that arrive while "
+                                 "the queue is full are dropped. The number of dropped messages "
+                                 "is shown in the performance snapin of the Event Console. "
+                                 "Messages from the event pipe, the event socket, syslog via TCP "
+                                 "and spool files are never dropped. Reading them is delayed "
+                                 "until the queue has room again."),
+                        minvalue = 1,
+                        default_value = 100000,
+                        unit = _("messages"),
+                    ),
+                    Integer(
+                        title = _("Maximum number of messages processed in one batch"),
+                        minvalue = 1,
+                        default_value = 500,
+                        unit = _("messages"),
+                    ),
+                ],
+            ),
+            title = _("Process messages in a separate thread"),
+            help = _("Per default the Event Console processes each incoming message before it "
+                     "reads the next one. If a device floods the Event Console with messages, "
+                     "the buffers of the operating system may overflow and messages are lost "
+                     "without notice. With this option incoming messages are read and decoded "
+                     "by one thread and put into a queue. A second thread takes the messages "
+                     "from the queue and applies the rules in batches."),
+            label = _("Use a queue between receiving and processing messages"),
+            none_label = _("messages are processed when received"),
+        ),
+        domain = "mkeventd",
+    )
+
     register_configvar(group,
         "translate_snmptraps",
         Transform(
@@ -369,11 +369,13 @@ def automation_delete_host(args):
         "%s/%s"              % (tcp_cache_dir, hostname),
         "%s/persisted/%s"    % (var_dir, hostname),
         "%s/piggyback/%s"    % (tmp_dir, hostname),
-        "%s/inventory/%s"    % (var_dir, hostname),
         "%s/inventory/%s.gz" % (var_dir, hostname)]:
         if os.path.exists(path):
             os.unlink(path)
 
+    # the current inventory tree is needed for restoring the archive
+    archive_current_inv_tree(hostname)
+
     # files from snmp devices
     for filename in os.listdir(tcp_cache_dir):
         if filename.startswith("%s." % hostname):
@@ -754,6 +756,9 @@ def rename_host_files(oldname, newname):
             if rename_host_file(piggybase + piggydir, oldname, newname):
                 actions.append("piggyback-pig")
 
+    if "piggyback-load" in actions or "piggyback-pig" in actions:
+        invalidate_piggyback_index()
+
     # Logwatch
     if rename_host_dir(logwatch_dir, oldname, newname):
         actions.append("logwatch")
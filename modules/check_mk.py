@@ -34,6 +34,7 @@
 import os
 import sys
 import time
+import datetime
 import socket
 import getopt
 import re
@@ -43,6 +44,10 @@ import subprocess
 import fcntl
 import py_compile
 import inspect
+import bisect
+import hashlib
+import cStringIO
+import opcode
 
 # These variable will be substituted at 'make dist' time
 check_mk_version  = '(inofficial)'
@@ -383,6 +388,21 @@ def load_checks():
     verify_checkgroup_members()
 
 
+# Fingerprint of the check files: their paths, modification times and
+# sizes. It is used for dropping caches that depend on the checks.
+g_checks_fingerprint = None
+def checks_fingerprint():
+    global g_checks_fingerprint
+    if g_checks_fingerprint == None:
+        fingerprint = hashlib.md5()
+        for path in plugin_pathnames_in_directory(checks_dir) \
+                  + plugin_pathnames_in_directory(local_checks_dir):
+            st = os.stat(path)
+            fingerprint.update("%s %d %d\n" % (path, st.st_mtime, st.st_size))
+        g_checks_fingerprint = fingerprint.hexdigest()
+    return g_checks_fingerprint
+
+
 def checks_by_checkgroup():
     groups = {}
     for check_type, check in check_info.items():
@@ -652,8 +672,11 @@ def parents_of(hostname):
 g_converted_host_rulesets_cache = {}
 g_global_caches.append('g_converted_host_rulesets_cache')
 
+# Converts a host ruleset into an index from host name to the list
+# of the values of all matching rules (in the order of the rules).
+# Looking up the values for a host is then a simple dict access.
 def convert_host_ruleset(ruleset):
-    new_rules = []
+    index = {}
     if len(ruleset) == 1 and ruleset[0] == "":
         sys.stderr.write('WARNING: deprecated entry [ "" ] in host configuration list\n')
 
@@ -674,23 +697,21 @@ def convert_host_ruleset(ruleset):
 
         # Directly compute set of all matching hosts here, this
         # will avoid recomputation later
-        new_rules.append((item, all_matching_hosts(tags, hostlist, with_foreign_hosts=True)))
+        for hostname in all_matching_hosts(tags, hostlist, with_foreign_hosts=True):
+            index.setdefault(hostname, []).append(item)
 
-    g_converted_host_rulesets_cache[id(ruleset)] = new_rules
-    return new_rules
+    g_converted_host_rulesets_cache[id(ruleset)] = index
+    return index
 
 
 def host_extra_conf(hostname, ruleset):
     try:
-        ruleset = g_converted_host_rulesets_cache[id(ruleset)]
+        index = g_converted_host_rulesets_cache[id(ruleset)]
     except KeyError:
-        ruleset = convert_host_ruleset(ruleset)
+        index = convert_host_ruleset(ruleset)
 
-    entries = []
-    for item, hostname_list in ruleset:
-        if hostname in hostname_list:
-            entries.append(item)
-    return entries
+    # Return a copy, callers are allowed to modify the list
+    return index.get(hostname, [])[:]
 
 
 def host_extra_conf_merged(hostname, conf):
@@ -810,8 +831,76 @@ def convert_pattern_list(patterns):
 g_hostlist_match_cache = {}
 g_global_caches.append('g_hostlist_match_cache')
 
+g_hostlist_index_cache = {}
+g_global_caches.append('g_hostlist_index_cache')
+
+# Returns an index of all valid hosts that is used by all_matching_hosts()
+# in order to reduce the number of hosts that need to be matched against
+# a rule. The index is a pair of the sorted list of host names (for looking
+# up name prefixes) and a dictionary from host tag to the set of hosts
+# having that tag.
+def hostlist_index(with_foreign_hosts):
+    try:
+        return g_hostlist_index_cache[with_foreign_hosts]
+    except KeyError:
+        pass
+
+    if with_foreign_hosts:
+        valid_hosts = all_configured_hosts()
+    else:
+        valid_hosts = all_active_hosts()
+
+    hosts_by_tag = {}
+    for hostname in valid_hosts:
+        for tag in tags_of_host(hostname):
+            hosts_by_tag.setdefault(tag, set([])).add(hostname)
+
+    index = sorted(set(valid_hosts)), hosts_by_tag
+    g_hostlist_index_cache[with_foreign_hosts] = index
+    return index
+
+
+# Determines the literal text a regular expression requires at the
+# beginning of each match. Returns "" if this is unknown.
+def regex_literal_prefix(pattern):
+    if '|' in pattern:
+        return "" # alternatives might match anything
+    prefix = ""
+    for c in pattern:
+        if c in '?*{':
+            return prefix[:-1] # quantifier makes last character optional
+        elif c in '.^$[]()}+\\':
+            break
+        prefix += c
+    return prefix
+
+
+# Computes the set of hosts that can possibly be matched by a host list
+# (see in_extraconf_hostlist()) without doing the actual matching. Plain
+# host names and regexes with a literal prefix limit the candidates,
+# everything else (negations, @all, ...) means all hosts (None).
+def hostlist_candidates(hostlist, sorted_hosts):
+    candidates = set([])
+    for hostentry in hostlist:
+        if not hostentry or hostentry[0] in '@!':
+            return None
+
+        elif hostentry[0] == '~':
+            prefix = regex_literal_prefix(hostentry[1:])
+            if not prefix:
+                return None
+            index = bisect.bisect_left(sorted_hosts, prefix)
+            while index < len(sorted_hosts) and sorted_hosts[index].startswith(prefix):
+                candidates.add(sorted_hosts[index])
+                index += 1
+
+        else:
+            candidates.add(hostentry)
+    return candidates
+
+
 def all_matching_hosts(tags, hostlist, with_foreign_hosts=False):
-    cache_id = tuple(tags), tuple(hostlist)
+    cache_id = tuple(tags), tuple(hostlist), with_foreign_hosts
     try:
         return g_hostlist_match_cache[cache_id]
     except KeyError:
@@ -822,6 +911,21 @@ def all_matching_hosts(tags, hostlist, with_foreign_hosts=False):
     else:
         valid_hosts = all_active_hosts()
 
+    # Only hosts that have all required (not negated, no prefix) tags
+    # and that are possibly matched by the host list need to be checked
+    sorted_hosts, hosts_by_tag = hostlist_index(with_foreign_hosts)
+    candidates = hostlist_candidates(hostlist, sorted_hosts)
+    for tag in tags:
+        if tag and tag[0] != '!' and tag[-1] != '+':
+            tagged_hosts = hosts_by_tag.get(tag, set([]))
+            if candidates is None:
+                candidates = tagged_hosts
+            else:
+                candidates = candidates.intersection(tagged_hosts)
+
+    if candidates is not None:
+        valid_hosts = [ h for h in valid_hosts if h in candidates ]
+
     matching = set([])
     for hostname in valid_hosts:
         # When no tag matching is requested, do not filter by tags. Accept all hosts
@@ -837,8 +941,11 @@ def all_matching_hosts(tags, hostlist, with_foreign_hosts=False):
 g_converted_service_rulesets_cache = {}
 g_global_caches.append('g_converted_service_rulesets_cache')
 
+# Converts a service ruleset into an index from host name to the list
+# of the rules matching that host. Each rule is reduced to a pair of
+# its value and the precompiled service matchers.
 def convert_service_ruleset(ruleset):
-    new_rules = []
+    index = {}
     for rule in ruleset:
         rule, rule_options = get_rule_options(rule)
         if rule_options.get("disabled"):
@@ -854,15 +961,16 @@ def convert_service_ruleset(ruleset):
             raise MKGeneralException("Invalid rule '%r' in service configuration "
                                      "list: must have 3 or 4 elements" % (rule,))
 
+        # And now preprocess the configured patterns in the servlist
+        rule = item, convert_pattern_list(servlist)
+
         # Directly compute set of all matching hosts here, this
         # will avoid recomputation later
-        hosts = all_matching_hosts(tags, hostlist)
-
-        # And now preprocess the configured patterns in the servlist
-        new_rules.append((item, hosts, convert_pattern_list(servlist)))
+        for hostname in all_matching_hosts(tags, hostlist):
+            index.setdefault(hostname, []).append(rule)
 
-    g_converted_service_rulesets_cache[id(ruleset)] = new_rules
-    return new_rules
+    g_converted_service_rulesets_cache[id(ruleset)] = index
+    return index
 
 
 g_extraconf_servicelist_cache = {}
@@ -871,27 +979,28 @@ g_global_caches.append('g_extraconf_servicelist_cache')
 # Compute outcome of a service rule set that has an item
 def service_extra_conf(hostname, service, ruleset):
     try:
-        ruleset = g_converted_service_rulesets_cache[id(ruleset)]
+        index = g_converted_service_rulesets_cache[id(ruleset)]
     except KeyError:
-        ruleset = convert_service_ruleset(ruleset)
+        index = convert_service_ruleset(ruleset)
 
     entries = []
-    for item, hosts, service_matchers in ruleset:
-        if hostname in hosts:
-            cache_id = service_matchers, service
-            try:
-                match = g_extraconf_servicelist_cache[cache_id]
-            except:
-                match = in_servicematcher_list(service_matchers, service)
-                g_extraconf_servicelist_cache[cache_id] = match
+    for item, service_matchers in index.get(hostname, []):
+        cache_id = service_matchers, service
+        try:
+            match = g_extraconf_servicelist_cache[cache_id]
+        except:
+            match = in_servicematcher_list(service_matchers, service)
+            g_extraconf_servicelist_cache[cache_id] = match
 
-            if match:
-                entries.append(item)
+        if match:
+            entries.append(item)
     return entries
 
 
+# Same as convert_service_ruleset(), but for rulesets without values.
+# The rules are reduced to pairs of negate and service matchers.
 def convert_boolean_service_ruleset(ruleset):
-    new_rules = []
+    index = {}
     for rule in ruleset:
         entry, rule_options = get_rule_options(rule)
         if rule_options.get("disabled"):
@@ -914,31 +1023,31 @@ def convert_boolean_service_ruleset(ruleset):
 
         # Directly compute set of all matching hosts here, this
         # will avoid recomputation later
-        hosts = all_matching_hosts(tags, hostlist)
-        new_rules.append((negate, hosts, convert_pattern_list(servlist)))
+        rule = negate, convert_pattern_list(servlist)
+        for hostname in all_matching_hosts(tags, hostlist):
+            index.setdefault(hostname, []).append(rule)
 
-    g_converted_service_rulesets_cache[id(ruleset)] = new_rules
-    return new_rules
+    g_converted_service_rulesets_cache[id(ruleset)] = index
+    return index
 
 
 # Compute outcome of a service rule set that just say yes/no
 def in_boolean_serviceconf_list(hostname, service_description, ruleset):
     try:
-        ruleset = g_converted_service_rulesets_cache[id(ruleset)]
+        index = g_converted_service_rulesets_cache[id(ruleset)]
     except KeyError:
-        ruleset = convert_boolean_service_ruleset(ruleset)
+        index = convert_boolean_service_ruleset(ruleset)
 
-    for negate, hosts, service_matchers in ruleset:
-        if hostname in hosts:
-            cache_id = service_matchers, service_description
-            try:
-                match = g_extraconf_servicelist_cache[cache_id]
-            except:
-                match = in_servicematcher_list(service_matchers, service_description)
-                g_extraconf_servicelist_cache[cache_id] = match
+    for negate, service_matchers in index.get(hostname, []):
+        cache_id = service_matchers, service_description
+        try:
+            match = g_extraconf_servicelist_cache[cache_id]
+        except:
+            match = in_servicematcher_list(service_matchers, service_description)
+            g_extraconf_servicelist_cache[cache_id] = match
 
-            if match:
-                return not negate
+        if match:
+            return not negate
     return False # no match. Do not ignore
 
 
@@ -1429,6 +1538,9 @@ def is_snmpv2c_host(hostname):
 def is_usewalk_host(hostname):
     return in_binary_hostlist(hostname, usewalk_hosts)
 
+def is_snmp_table_walk_host(hostname):
+    return in_binary_hostlist(hostname, snmp_table_walk_hosts)
+
 def snmp_timing_of(hostname):
     timing = host_extra_conf(hostname, snmp_timing)
     if len(timing) > 0:
@@ -1543,6 +1655,16 @@ def snmp_get_oid(hostname, ipaddress, oid):
         return None
 
     item, value = line.split("=", 1)
+    value = snmp_answer_value(value)
+
+    # In case of .*, check if prefix is the one we are looking for
+    if commandtype == "getnext" and not item.startswith(oid_prefix + "."):
+        value = None
+
+    return value
+
+
+def snmp_answer_value(value):
     value = value.strip()
     if opt_debug:
         sys.stdout.write("SNMP answer: ==> [%s]\n" % value)
@@ -1550,16 +1672,86 @@ def snmp_get_oid(hostname, ipaddress, oid):
        or value.startswith('No Such Object available') or value.startswith('No Such Instance currently exists'):
         value = None
 
-    # In case of .*, check if prefix is the one we are looking for
-    if commandtype == "getnext" and not item.startswith(oid_prefix + "."):
-        value = None
-
     # Strip quotes
     if value and value.startswith('"') and value.endswith('"'):
         value = value[1:-1]
     return value
 
 
+# Fetches several OIDs (like get_single_oid()) with as few SNMP requests
+# as possible and puts them into the OID cache. This is only done with
+# classic SNMP. In all other cases and in case of an error the OIDs are
+# fetched one by one later by get_single_oid().
+def prefetch_single_oids(hostname, ipaddress, oids):
+    clear_other_hosts_oid_cache(hostname)
+    if opt_use_snmp_walk or is_usewalk_host(hostname) or (has_inline_snmp and use_inline_snmp):
+        return
+
+    oids = [ oid for oid in oids if oid not in g_single_oid_cache ]
+    for commandtype, requested in [
+        ("get",     [ oid for oid in oids if not oid.endswith(".*") ]),
+        ("getnext", [ oid for oid in oids if oid.endswith(".*") ]) ]:
+        while requested:
+            chunk, requested = requested[:50], requested[50:]
+            try:
+                values = snmp_get_oids(hostname, ipaddress, commandtype, chunk)
+            except:
+                if opt_debug:
+                    raise
+                values = None
+            if values != None:
+                for oid, value in values.items():
+                    set_oid_cache(hostname, oid, value)
+
+
+# Returns a dict from OID to value or None in case of an error
+def snmp_get_oids(hostname, ipaddress, commandtype, oids):
+    if commandtype == "getnext":
+        oid_prefixes = [ oid[:-2] for oid in oids ]
+    else:
+        oid_prefixes = oids
+
+    protospec = snmp_proto_spec(hostname)
+    portspec = snmp_port_spec(hostname)
+    command = snmp_base_command(commandtype, hostname) + \
+              " -On -OQ -Oe -Ot %s%s%s %s" % (protospec, ipaddress, portspec, " ".join(oid_prefixes))
+
+    if opt_debug:
+        sys.stdout.write("Running '%s'\n" % command)
+
+    snmp_process = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    output = snmp_process.stdout.read()
+    if snmp_process.wait():
+        return None
+
+    answers = []
+    for line in output.splitlines():
+        if line.startswith(".") and "=" in line:
+            item, value = line.split("=", 1)
+            answers.append((item.strip(), value))
+
+    values = {}
+    if commandtype == "getnext":
+        # The answers come in the order of the request. Each answer has
+        # the OID following the requested prefix.
+        if len(answers) != len(oids):
+            return None
+        for oid, oid_prefix, (item, value) in zip(oids, oid_prefixes, answers):
+            if item.startswith(oid_prefix + "."):
+                values[oid] = snmp_answer_value(value)
+            else:
+                values[oid] = None
+    else:
+        # Not existing OIDs are missing in the answer of SNMP v1 agents
+        answered = dict(answers)
+        for oid in oids:
+            if oid in answered:
+                values[oid] = snmp_answer_value(answered[oid])
+            else:
+                values[oid] = None
+    return values
+
+
 def clear_other_hosts_oid_cache(hostname):
     global g_single_oid_hostname
     if g_single_oid_hostname != hostname:
@@ -2954,6 +3146,39 @@ def do_restore(tarname):
         sys.stderr.write("Successfully restored backup.\n")
 
 
+# Moves the current inventory tree of a host completely into the
+# inventory archive instead of deleting it. The archived trees are
+# mostly stored as deltas (see modules/inventory.py), which can only be
+# restored starting from the current tree. Returns True if there was
+# a tree to archive.
+def archive_current_inv_tree(hostname):
+    path = var_dir + "/inventory/" + hostname
+    if not os.path.exists(path):
+        return False
+
+    arcdir = var_dir + "/inventory_archive/" + hostname
+    if not os.path.exists(arcdir):
+        os.makedirs(arcdir)
+
+    # An entry with the same time stamp is an older tree that has been
+    # archived within the same second. It is kept and the current tree
+    # is not archived. A delta needs the current tree as base, so the
+    # older tree is stored completely instead.
+    arcpath = arcdir + ("/%d" % os.stat(path).st_mtime)
+    if os.path.exists(arcpath + ".delta"):
+        if "inv_apply_delta" not in globals():
+            load_module("inventory")
+        delta = eval(file(arcpath + ".delta").read())
+        older_tree = inv_apply_delta(eval(file(path).read()), delta)
+        file(arcpath, "w").write("%r\n" % (older_tree,))
+        os.remove(arcpath + ".delta")
+        os.remove(path)
+    elif os.path.exists(arcpath):
+        os.remove(path)
+    else:
+        os.rename(path, arcpath)
+    return True
+
 def do_flush(hosts):
     if not hosts:
         hosts = all_active_hosts()
@@ -3017,9 +3242,7 @@ def do_flush(hosts):
             sys.stdout.write(tty_bold + tty_cyan + " autochecks(%d)" % count)
 
         # inventory
-        path = var_dir + "/inventory/" + host
-        if os.path.exists(path):
-            os.remove(path)
+        if archive_current_inv_tree(host):
             sys.stdout.write(tty_bold + tty_yellow + " inventory")
 
         if not flushed:
@@ -3054,12 +3277,14 @@ def create_core_config(use_rushd):
     verify_non_duplicate_hosts()
     verify_non_deprecated_checkgroups()
 
+    load_autochecks_cache()
     if monitoring_core == "cmc":
         warnings = do_create_cmc_config(opt_cmc_relfilename, use_rushd=use_rushd)
     else:
         load_module("nagios")
         out = file(nagios_objects_file, "w")
         warnings = create_nagios_config(out)
+    save_autochecks_cache()
 
     num_warnings = len(g_configuration_warnings)
     if num_warnings > 10:
@@ -3683,6 +3908,7 @@ Copyright (C) 2009 Mathias Kettner
 def usage():
     print """WAYS TO CALL:
  cmk [-n] [-v] [-p] HOST [IPADDRESS]  check all services on HOST
+ cmk --check-batch HOST1 HOST2 ...    check several hosts, fetch agent data in parallel
  cmk -I [HOST ..]                     inventory - find new services
  cmk -II ...                          renew inventory, drop old services
  cmk -N [HOSTS...]                    output Nagios configuration
@@ -3717,7 +3943,8 @@ def usage():
  cmk --notify                         used to send notifications from core
  cmk --create-rrd [--keepalive|SPEC]  create round robin database (only CEE)
  cmk --convert-rrds [--split] [H...]  convert exiting RRD to new format (only CEE)
- cmk --compress-history FILES...      optimize monitoring history files for CMC
+ cmk --compress-history [--gzip] F... optimize monitoring history files (or
+                                      directories of them) for CMC
  cmk --handle-alerts                  alert handling, always in keepalive mode (only CEE)
  cmk -i, --inventory [HOST1 HOST2...] Do a HW/SW-Inventory of some ar all hosts
  cmk --inventory-as-check HOST        Do HW/SW-Inventory, behave like check plugin
@@ -3744,8 +3971,11 @@ OPTIONS:
   --interactive  Some errors are only reported in interactive mode, i.e. if stdout
                  is a TTY. This option forces interactive mode even if the output
                  is directed into a pipe or file.
-  --procs N      start up to N processes in parallel during --scan-parents
+  --procs N      start up to N processes in parallel during --scan-parents,
+                 -I, -II, --discover-marked-hosts and --compress-history
+  --gzip         with --compress-history: write gzip compressed files
   --checks A,..  restrict checks/inventory to specified checks (tcp/snmp/check type)
+  --connections N open up to N agent connections in parallel during --check-batch
   --keepalive    used by Check_MK Mirco Core: run check and --notify
                  in continous mode. Read data from stdin and from cmd line.
   --cmc-file=X   relative filename for CMC config file (used by -B/-U)
@@ -3779,6 +4009,13 @@ NOTES:
   -d does not work on clusters (such defined in main.mk) but only on
   real hosts.
 
+  --check-batch checks all services of the given hosts (or tag
+  specifications) in one run. The agent data of all TCP hosts is fetched
+  in parallel with non-blocking connections. The checks of a host are
+  executed as soon as its agent has delivered its data. The number of
+  parallel connections is limited by check_batch_max_connections in
+  main.mk or by the option --connections.
+
   --check-discovery make check_mk behave as monitoring plugins that
   checks if an inventory would find new or vanished services for the host.
   If configured to do so, this will queue those hosts for automatic
@@ -4392,6 +4629,8 @@ def cleanup_globals():
     g_inactive_timerperiods = None
     global g_walk_cache
     g_walk_cache = {}
+    global g_snmp_subtree_cache
+    g_snmp_subtree_cache = {}
     global g_timeout
     g_timeout = None
 
@@ -4467,9 +4706,6 @@ def add_keepalive_check_result(service, state, output, cached_at=None, cache_int
 def do_check_keepalive():
     global g_initial_times, g_timeout, g_total_check_output
 
-    def check_timeout(signum, frame):
-        raise MKCheckTimeout()
-
     signal.signal(signal.SIGALRM, signal.SIG_IGN) # Prevent ALRM from CheckHelper.cc
 
     # Prevent against plugins that output debug information (but shouldn't).
@@ -4497,6 +4733,10 @@ def do_check_keepalive():
 
     g_total_check_output = ""
 
+    if keepalive_fork_workers and not g_profile:
+        keepalive_worker_loop(keepalive_fd)
+        return
+
     if opt_verbose:
         original_global_vars = copy_globals()
 
@@ -4518,80 +4758,10 @@ def do_check_keepalive():
         elif not cmdline:
             break
 
-        # Always cleanup the total check output var before handling a new task
-        g_total_check_output = ""
-
         num_checks += 1
 
-        g_timeout = int(keepalive_read_line())
-        try: # catch non-timeout exceptions
-            try: # catch timeouts
-                signal.signal(signal.SIGALRM, check_timeout)
-                signal.alarm(g_timeout)
-
-                # The CMC always provides arguments. This is the only used case for CMC. The last
-                # two arguments are the hostname and the ipaddress of the host to be asked for.
-                # The other arguments might be different parameters to configure the actions to
-                # be done
-                args = cmdline.split()
-                if '--cache' in args:
-                    args.remove('--cache')
-                    enforce_using_agent_cache()
-
-                # FIXME: remove obsolete check-inventory
-                if '--check-inventory' in args:
-                    args.remove('--check-inventory')
-                    mode_function = check_discovery
-                elif '--check-discovery' in args:
-                    args.remove('--check-discovery')
-                    mode_function = check_discovery
-                else:
-                    mode_function = do_check
-
-                if len(args) >= 2:
-                    hostname, ipaddress = args[:2]
-                else:
-                    hostname = args[0]
-                    ipaddress = None
-
-                if ipaddress == None:
-                    if hostname in ipaddress_cache:
-                        ipaddress = ipaddress_cache[hostname]
-                    else:
-                        if is_cluster(hostname):
-                            ipaddress = None
-                        else:
-                            try:
-                                ipaddress = lookup_address(hostname)
-                            except:
-                                raise MKGeneralException("Cannot resolve hostname %s into IP address" % hostname)
-                        ipaddress_cache[hostname] = ipaddress
-
-                status = mode_function(hostname, ipaddress)
-                signal.signal(signal.SIGALRM, signal.SIG_IGN) # Prevent ALRM from CheckHelper.cc
-                signal.alarm(0)
-
-            except MKCheckTimeout:
-                signal.signal(signal.SIGALRM, signal.SIG_IGN) # Prevent ALRM from CheckHelper.cc
-                spec = exit_code_spec(hostname)
-                status = spec.get("timeout", 2)
-                g_total_check_output = "%s - Check_MK timed out after %d seconds\n" % (
-                    core_state_names[status], g_timeout)
-
-            check_output_utf8 = make_utf8(g_total_check_output)
-            os.write(keepalive_fd, "%03d\n%08d\n%s" % (status, len(check_output_utf8), check_output_utf8))
-            g_total_check_output = ""
-
-        except Exception, e:
-            signal.signal(signal.SIGALRM, signal.SIG_IGN) # Prevent ALRM from CheckHelper.cc
-            signal.alarm(0)
-            if opt_debug:
-                raise
-            else:
-                import traceback # Always log details to the cmc.log
-                traceback.print_exc()
-            output = "UNKNOWN - %s\n" % e
-            os.write(keepalive_fd, "%03d\n%08d\n%s" % (3, len(output), output))
+        timeout = int(keepalive_read_line())
+        keepalive_process_request(cmdline, timeout, keepalive_fd, ipaddress_cache)
 
         # Flush file descriptors of stdout and stderr, so that diagnostic
         # messages arrive in time in cmc.log
@@ -4626,6 +4796,227 @@ def do_check_keepalive():
         # end of while True:...
 
 
+# Executes one check command sent by the core and writes the answer
+# to keepalive_fd. This is used by the classic keepalive loop as well
+# as by the forked keepalive workers.
+def keepalive_process_request(cmdline, timeout, keepalive_fd, ipaddress_cache):
+    global g_timeout, g_total_check_output
+
+    def check_timeout(signum, frame):
+        raise MKCheckTimeout()
+
+    # Always cleanup the total check output var before handling a new task
+    g_total_check_output = ""
+    g_timeout = timeout
+
+    try: # catch non-timeout exceptions
+        try: # catch timeouts
+            signal.signal(signal.SIGALRM, check_timeout)
+            signal.alarm(g_timeout)
+
+            # The CMC always provides arguments. This is the only used case for CMC. The last
+            # two arguments are the hostname and the ipaddress of the host to be asked for.
+            # The other arguments might be different parameters to configure the actions to
+            # be done
+            args = cmdline.split()
+            if '--cache' in args:
+                args.remove('--cache')
+                enforce_using_agent_cache()
+
+            # FIXME: remove obsolete check-inventory
+            if '--check-inventory' in args:
+                args.remove('--check-inventory')
+                mode_function = check_discovery
+            elif '--check-discovery' in args:
+                args.remove('--check-discovery')
+                mode_function = check_discovery
+            else:
+                mode_function = do_check
+
+            if len(args) >= 2:
+                hostname, ipaddress = args[:2]
+            else:
+                hostname = args[0]
+                ipaddress = None
+
+            if ipaddress == None:
+                ipaddress = keepalive_lookup_ipaddress(hostname, ipaddress_cache)
+
+            status = mode_function(hostname, ipaddress)
+            signal.signal(signal.SIGALRM, signal.SIG_IGN) # Prevent ALRM from CheckHelper.cc
+            signal.alarm(0)
+
+        except MKCheckTimeout:
+            signal.signal(signal.SIGALRM, signal.SIG_IGN) # Prevent ALRM from CheckHelper.cc
+            spec = exit_code_spec(hostname)
+            status = spec.get("timeout", 2)
+            g_total_check_output = "%s - Check_MK timed out after %d seconds\n" % (
+                core_state_names[status], g_timeout)
+
+        check_output_utf8 = make_utf8(g_total_check_output)
+        os.write(keepalive_fd, "%03d\n%08d\n%s" % (status, len(check_output_utf8), check_output_utf8))
+        g_total_check_output = ""
+
+    except Exception, e:
+        signal.signal(signal.SIGALRM, signal.SIG_IGN) # Prevent ALRM from CheckHelper.cc
+        signal.alarm(0)
+        if opt_debug:
+            raise
+        else:
+            import traceback # Always log details to the cmc.log
+            traceback.print_exc()
+        output = "UNKNOWN - %s\n" % e
+        os.write(keepalive_fd, "%03d\n%08d\n%s" % (3, len(output), output))
+
+
+def keepalive_lookup_ipaddress(hostname, ipaddress_cache):
+    if hostname in ipaddress_cache:
+        return ipaddress_cache[hostname]
+
+    if is_cluster(hostname):
+        ipaddress = None
+    else:
+        try:
+            ipaddress = lookup_ip_address(hostname)
+        except:
+            raise MKGeneralException("Cannot resolve hostname %s into IP address" % hostname)
+    ipaddress_cache[hostname] = ipaddress
+    return ipaddress
+
+
+# Keepalive mode with forked workers (keepalive_fork_workers = True). The
+# configuration is loaded once into this master process. For each check
+# a worker is forked off this master *before* the request arrives. The
+# worker shares the loaded configuration copy-on-write, handles exactly
+# one request and exits. So every check starts with clean global
+# variables and nothing needs to be reset or verified between two checks.
+# The caches that only depend on the configuration are filled in the
+# master before the first worker is forked, so that the workers inherit
+# them. IP addresses are resolved and cached by the master as well.
+# A reload ("*") simply drops the idle worker of the old configuration,
+# loads the new one and forks the next generation.
+def keepalive_worker_loop(keepalive_fd):
+    keepalive_fill_caches()
+    ipaddress_cache = {}
+    worker = None
+    while True:
+        if worker is None:
+            worker = keepalive_fork_worker(keepalive_fd)
+
+        cmdline = keepalive_read_line().strip()
+        if cmdline == "*":
+            keepalive_stop_worker(worker)
+            worker = None
+            read_packed_config()
+            cleanup_globals()
+            reset_global_caches()
+            keepalive_fill_caches()
+            ipaddress_cache = {}
+            continue
+
+        elif not cmdline:
+            keepalive_stop_worker(worker)
+            break
+
+        timeout = keepalive_read_line().strip()
+
+        # Pass the address to the worker if the core did not send one.
+        # Lookup errors are reported by the worker.
+        address_line = ""
+        args = [ a for a in cmdline.split() if not a.startswith("--") ]
+        if len(args) == 1:
+            try:
+                ipaddress = keepalive_lookup_ipaddress(args[0], ipaddress_cache)
+                if ipaddress:
+                    address_line = "%s %s" % (args[0], ipaddress)
+            except MKGeneralException:
+                pass
+
+        pid, request_fd = worker
+        worker = None
+        os.write(request_fd, "%s\n%s\n%s\n" % (cmdline, timeout, address_line))
+        os.close(request_fd)
+
+        exit_status = os.waitpid(pid, 0)[1]
+        if exit_status != 0:
+            # The worker died before it could send an answer
+            sys.stderr.write("Check helper worker %d for [%s] died with exit status %d\n" %
+                             (pid, cmdline, exit_status))
+            output = "UNKNOWN - Check helper worker died unexpectedly\n"
+            os.write(keepalive_fd, "%03d\n%08d\n%s" % (3, len(output), output))
+        sys.stderr.flush()
+
+
+# Forks a new keepalive worker. It waits for one request on a pipe.
+# Returns the pair (pid, fd) of the worker and the write end of that pipe.
+def keepalive_fork_worker(keepalive_fd):
+    global g_initial_times
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    read_fd, request_fd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(read_fd)
+        return pid, request_fd
+
+    # Worker: never return into the code of the master process
+    exit_status = 0
+    try:
+        try:
+            os.close(request_fd)
+            request = ""
+            while True:
+                chunk = os.read(read_fd, 4096)
+                if not chunk:
+                    break
+                request += chunk
+            os.close(read_fd)
+
+            lines = request.split("\n")
+            if len(lines) >= 2 and lines[0]:
+                ipaddress_cache = {}
+                if len(lines) >= 3 and lines[2]:
+                    hostname, ipaddress = lines[2].split()
+                    ipaddress_cache[hostname] = ipaddress
+                g_initial_times = os.times()
+                keepalive_process_request(lines[0], int(lines[1]), keepalive_fd, ipaddress_cache)
+        except:
+            import traceback # Always log details to the cmc.log
+            traceback.print_exc()
+            exit_status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_status)
+
+
+# Fills the caches that only depend on the configuration by doing the
+# configuration lookups of a check for all hosts: the converted rulesets,
+# the host list indexes and the check tables. The agents are not contacted.
+def keepalive_fill_caches():
+    init_ip_lookup_cache()
+    for hostname in all_active_hosts():
+        try:
+            exit_code_spec(hostname)
+            agent_target_version(hostname)
+            for check_type, item, params, description, deps in \
+                    get_sorted_check_table(hostname, remove_duplicates=True, world="active"):
+                check_period_of(hostname, description)
+                aggregated_service_name(hostname, description)
+        except Exception, e:
+            if opt_debug:
+                raise
+            sys.stderr.write("Cannot compute the configuration of %s: %s\n" % (hostname, e))
+
+
+# Stops an idle worker by closing its request pipe without sending a request
+def keepalive_stop_worker(worker):
+    pid, request_fd = worker
+    os.close(request_fd)
+    os.waitpid(pid, 0)
+
+
 # Just one lines from stdin. But: make sure that
 # nothing more is read - not even into some internal
 # buffer of sys.stdin! We do this by reading every
@@ -4644,6 +5035,60 @@ def keepalive_read_line():
             line += byte
 
 
+# Checks a list of hosts in one run (cmk --check-batch). The agent outputs
+# of all plain TCP hosts are fetched in parallel and the checks of each
+# host are executed as soon as its data has arrived. All other hosts
+# (datasource programs, SNMP-only hosts, cached or simulated data) are
+# checked one by one afterwards. Clusters come last, so that they can use
+# the fresh cache files of their nodes. Returns the worst exit status.
+def do_check_batch(hostnames, only_check_types = None):
+    prefetch_hosts = []
+    other_hosts = []
+    cluster_hosts = []
+    exit_status = 0
+
+    for hostname in hostnames:
+        if is_cluster(hostname):
+            cluster_hosts.append((hostname, None))
+            continue
+
+        try:
+            ipaddress = lookup_ip_address(hostname)
+        except:
+            sys.stdout.write("%s: UNKNOWN - Cannot resolve hostname '%s'.\n" % (hostname, hostname))
+            exit_status = worst_monitoring_state(exit_status, 3)
+            continue
+
+        if is_tcp_host(hostname) \
+           and not opt_use_cachefile and not opt_no_tcp and not simulation_mode \
+           and not get_datasource_program(hostname, ipaddress):
+            prefetch_hosts.append((hostname, ipaddress))
+        else:
+            other_hosts.append((hostname, ipaddress))
+
+    def check_host(hostname, ipaddress):
+        sys.stdout.write("%s: " % hostname)
+        try:
+            status = do_check(hostname, ipaddress, only_check_types)
+        finally:
+            g_prefetched_agent_outputs.pop(hostname, None)
+            cleanup_globals()
+        sys.stdout.flush()
+        return status
+
+    verbose("Fetching agent data of %d hosts (at most %d in parallel).\n" %
+            (len(prefetch_hosts), check_batch_max_connections))
+    ipaddresses = dict(prefetch_hosts)
+    for hostname, output in fetch_agent_infos_tcp(prefetch_hosts, check_batch_max_connections):
+        g_prefetched_agent_outputs[hostname] = output
+        exit_status = worst_monitoring_state(exit_status, check_host(hostname, ipaddresses[hostname]))
+
+    for hostname, ipaddress in other_hosts + cluster_hosts:
+        exit_status = worst_monitoring_state(exit_status, check_host(hostname, ipaddress))
+
+    return exit_status
+
+
 #.
 #   .--Read Config---------------------------------------------------------.
 #   |        ____                _    ____             __ _                |
@@ -4965,6 +5410,7 @@ load_checks()
 opt_nowiki     = False
 opt_split_rrds = False
 opt_delete_rrds = False
+opt_compress_gzip = False
 
 # Do option parsing and execute main function -
 short_options = 'ASHVLCURODMmd:Ic:nhvpXPNBilf'
@@ -4974,12 +5420,13 @@ long_options = [ "help", "version", "verbose", "compile", "debug", "interactive"
                  "snmptranslate", "bake-agents", "force", "show-snmp-stats",
                  "usewalk", "scan-parents", "procs=", "automation=", "handle-alerts", "notify",
                  "snmpget=", "profile", "keepalive", "keepalive-fd=", "create-rrd",
-                 "convert-rrds", "compress-history", "split-rrds", "delete-rrds",
+                 "convert-rrds", "compress-history", "gzip", "split-rrds", "delete-rrds",
                  "no-cache", "update", "restart", "reload", "dump", "fake-dns=",
                  "man", "nowiki", "config-check", "backup=", "restore=",
                  "check-inventory=", "check-discovery=", "discover-marked-hosts", "paths",
                  "checks=", "inventory", "inventory-as-check=", "hw-changes=", "sw-changes=",
-                 "cmc-file=", "browse-man", "list-man", "update-dns-cache", "cap" ]
+                 "cmc-file=", "browse-man", "list-man", "update-dns-cache", "cap",
+                 "check-batch", "connections=" ]
 
 non_config_options = ['-L', '--list-checks', '-P', '--package', '-M',
                       '--handle-alerts', '--notify',
@@ -5041,6 +5488,8 @@ for o,a in opts:
         opt_extra_oids.append(a)
     elif o == '--procs':
         max_num_processes = int(a)
+    elif o == '--connections':
+        check_batch_max_connections = int(a)
     elif o == '--nowiki':
         opt_nowiki = True
     elif o == '--debug':
@@ -5057,6 +5506,8 @@ for o,a in opts:
         opt_split_rrds = True
     elif o == "--delete-rrds":
         opt_delete_rrds = True
+    elif o == "--gzip":
+        opt_compress_gzip = True
     elif o == "--hw-changes":
         opt_inv_hw_changes = int(a)
     elif o == "--sw-changes":
@@ -5174,6 +5625,9 @@ try:
         elif o == '--discover-marked-hosts':
             discover_marked_hosts()
             done = True
+        elif o == '--check-batch':
+            exit_status = do_check_batch(parse_hostname_list(args), check_types)
+            done = True
         elif o == '--scan-parents':
             do_scan_parents(args)
             done = True
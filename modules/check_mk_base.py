@@ -52,6 +52,12 @@ import math
 import tempfile
 import traceback
 import subprocess
+import shutil
+import select
+import errno
+import marshal
+import struct
+import zlib
 
 # PLANNED CLEANUP:
 # - central functions for outputting verbose information and bailing
@@ -177,6 +183,7 @@ g_single_oid_cache           = {}
 g_broken_snmp_hosts          = set([])
 g_broken_agent_hosts         = set([])
 g_timeout                    = None
+g_prefetched_agent_outputs   = {} # agent outputs fetched in advance (cmk --check-batch)
 g_compiled_regexes           = {}
 g_global_caches              = []
 
@@ -447,7 +454,7 @@ def get_realhost_info(hostname, ipaddress, check_type, max_cache_age,
             raise
 
         if content:
-            return eval(content)
+            return deserialize_data(content)
         # Not cached -> need to get info via SNMP
 
         # Try to contact host only once
@@ -470,7 +477,7 @@ def get_realhost_info(hostname, ipaddress, check_type, max_cache_age,
         # prevent the regular checking from getting status updates during
         # interactive debugging, for example with cmk -nv.
         if not opt_dont_submit:
-            write_cache_file(cache_relpath, repr(table) + "\n")
+            write_cache_file(cache_relpath, serialize_data(table))
         return table
 
     # Note: even von SNMP-tagged hosts TCP based checks can be used, if
@@ -520,7 +527,7 @@ def get_realhost_info(hostname, ipaddress, check_type, max_cache_age,
     elif len(output) < 16:
         raise MKAgentError("Too short output from agent: '%s'" % output)
 
-    info, piggybacked, persisted, agent_cache_info = parse_info(output.split("\n"), hostname)
+    info, piggybacked, persisted, agent_cache_info = parse_info(output, hostname)
     g_agent_cache_info.setdefault(hostname, {}).update(agent_cache_info)
     store_piggyback_info(hostname, piggybacked)
     store_persisted_info(hostname, persisted)
@@ -546,14 +553,14 @@ def store_persisted_info(hostname, persisted):
     if persisted:
         if not os.path.exists(dir):
             os.makedirs(dir)
-        file(dir + hostname, "w").write("%r\n" % persisted)
+        write_data_file(dir + hostname, persisted)
         verbose("Persisted sections %s.\n" % ", ".join(persisted.keys()))
 
 
 def add_persisted_info(hostname, info):
     file_path = var_dir + "/persisted/" + hostname
     try:
-        persisted = eval(file(file_path).read())
+        persisted = read_data_file(file_path)
     except:
         return
 
@@ -639,8 +646,9 @@ def remove_piggyback_info_from(sourcehost, keep=[]):
     if not os.path.exists(piggyback_path):
         return # Nothing to do
 
-    for backedhost in os.listdir(piggyback_path):
-        if backedhost not in ['.', '..'] and backedhost not in keep:
+    backedhosts = get_piggyback_targets_of(sourcehost)
+    for backedhost in backedhosts:
+        if backedhost not in keep:
             path = piggyback_path + backedhost + "/" + sourcehost
             if os.path.exists(path):
                 verbose("Removing stale piggyback file %s\n" % path)
@@ -652,8 +660,79 @@ def remove_piggyback_info_from(sourcehost, keep=[]):
                 os.rmdir(piggyback_path + backedhost)
             except:
                 pass
+
+    if set(backedhosts) != set(keep):
+        set_piggyback_targets_of(sourcehost, keep)
     return removed
 
+
+# The piggyback files are stored per backed host in the directory
+# tmp/piggyback/<backedhost>/<sourcehost>. In order to find the files
+# a source host has created without scanning all of these directories,
+# an index of the backed hosts is kept per source host in the directory
+# tmp/piggyback_sources. If the index is missing, it is created once
+# from the piggyback directories.
+def piggyback_index_dir():
+    return tmp_dir + "/piggyback_sources/"
+
+
+def get_piggyback_targets_of(sourcehost):
+    if not os.path.exists(piggyback_index_dir()):
+        create_piggyback_index()
+    try:
+        return read_data_file(piggyback_index_dir() + sourcehost)
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return [] # no piggyback data from this host
+        raise
+
+
+def set_piggyback_targets_of(sourcehost, backedhosts):
+    path = piggyback_index_dir() + sourcehost
+    try:
+        if backedhosts:
+            write_data_file(path, sorted(backedhosts))
+        elif os.path.exists(path):
+            os.remove(path)
+    except (IOError, OSError), e:
+        # The index has been removed meanwhile. It will be recreated
+        # from the piggyback files.
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def create_piggyback_index():
+    piggyback_path = tmp_dir + "/piggyback/"
+    targets = {}
+    if os.path.exists(piggyback_path):
+        for backedhost in os.listdir(piggyback_path):
+            try:
+                sourcehosts = os.listdir(piggyback_path + backedhost)
+            except OSError:
+                continue
+            for sourcehost in sourcehosts:
+                if not sourcehost.startswith(".new."):
+                    targets.setdefault(sourcehost, []).append(backedhost)
+
+    # Build the index in a temporary directory and move it into place,
+    # so that concurrent processes never see an incomplete index.
+    tmp_path = tmp_dir + "/.piggyback_sources.new.%d" % os.getpid()
+    os.makedirs(tmp_path)
+    for sourcehost, backedhosts in targets.items():
+        write_data_file(tmp_path + "/" + sourcehost, sorted(backedhosts))
+    try:
+        os.rename(tmp_path, piggyback_index_dir().rstrip("/"))
+    except OSError:
+        # Another process has been faster
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# Needs to be called after piggyback files have been changed without
+# using the functions above, e.g. when renaming hosts.
+def invalidate_piggyback_index():
+    if os.path.exists(piggyback_index_dir()):
+        shutil.rmtree(piggyback_index_dir(), ignore_errors=True)
+
 def translate_piggyback_host(sourcehost, backedhost):
     translation = get_piggyback_translation(sourcehost)
 
@@ -754,6 +833,10 @@ def get_agent_info(hostname, ipaddress, max_cache_age):
         commandline = get_datasource_program(hostname, ipaddress)
         if commandline:
             output = get_agent_info_program(commandline)
+        elif hostname in g_prefetched_agent_outputs:
+            output = g_prefetched_agent_outputs.pop(hostname)
+            if isinstance(output, Exception):
+                raise output
         else:
             output = get_agent_info_tcp(hostname, ipaddress)
 
@@ -835,6 +918,113 @@ def get_agent_info_tcp(hostname, ipaddress, port = None):
                            (ipaddress, port, e))
 
 
+# Fetches the agent output of several hosts at once via TCP. Instead of
+# waiting for one agent after the other, up to max_connections non-blocking
+# sockets are handled in parallel by select(). This is a generator: Each
+# time an agent has sent its complete output (or failed) the tuple
+# (hostname, output) is yielded, so the caller can immediately process the
+# data while the other agents are still sending theirs. In case of an error
+# output is an MKAgentError instance instead of a string.
+# hosts is a list of pairs of (hostname, ipaddress).
+#
+# Same as with get_agent_info_tcp() tcp_connect_timeout is used for the
+# connect and as maximum time of inactivity on a connection. Time spent by
+# the caller between two yields is not accounted to the connections.
+def fetch_agent_infos_tcp(hosts, max_connections):
+    pending = list(hosts)
+    pending.reverse()
+    connections = {} # fileno -> [ hostname, ipaddress, port, socket, connected, chunks, last_activity ]
+
+    def open_connection(hostname, ipaddress):
+        port = agent_port_of(hostname)
+        if not ipaddress:
+            return MKGeneralException("Cannot contact agent: host '%s' has no IP address." % hostname)
+        try:
+            s = socket.socket(is_ipv6_primary(hostname) and socket.AF_INET6 or socket.AF_INET,
+                              socket.SOCK_STREAM)
+            s.setblocking(0)
+            vverbose("Connecting via TCP to %s:%d.\n" % (ipaddress, port))
+            err = s.connect_ex((ipaddress, port))
+            if err not in [ 0, errno.EINPROGRESS, errno.EWOULDBLOCK ]:
+                s.close()
+                raise socket.error(err, os.strerror(err))
+        except Exception, e:
+            return MKAgentError("Cannot get data from TCP port %s:%d: %s" % (ipaddress, port, e))
+        connections[s.fileno()] = [ hostname, ipaddress, port, s, err == 0, [], time.time() ]
+
+    def close_connection(fd):
+        hostname, ipaddress, port, s, connected, chunks, last_activity = connections.pop(fd)
+        s.close()
+        return hostname, ipaddress, port, "".join(chunks)
+
+    while pending or connections:
+        while pending and len(connections) < max_connections:
+            hostname, ipaddress = pending.pop()
+            error = open_connection(hostname, ipaddress)
+            if error:
+                yield hostname, error
+
+        finished = []
+        to_write = [ fd for fd, conn in connections.items() if not conn[4] ]
+        to_read  = [ fd for fd, conn in connections.items() if conn[4] ]
+        try:
+            readable, writable, exceptional = select.select(to_read, to_write, [], 1.0)
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                continue
+            raise
+
+        now = time.time()
+        for fd in writable:
+            conn = connections[fd]
+            err = conn[3].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                hostname, ipaddress, port, output = close_connection(fd)
+                finished.append((hostname, MKAgentError("Cannot get data from TCP port %s:%d: %s" %
+                                                        (ipaddress, port, os.strerror(err)))))
+            else:
+                conn[4] = True
+                conn[6] = now
+
+        for fd in readable:
+            conn = connections[fd]
+            try:
+                data = conn[3].recv(65536)
+            except socket.error, e:
+                if e[0] in [ errno.EAGAIN, errno.EINTR ]:
+                    continue
+                hostname, ipaddress, port, output = close_connection(fd)
+                finished.append((hostname, MKAgentError("Cannot get data from TCP port %s:%d: %s" %
+                                                        (ipaddress, port, e))))
+                continue
+
+            if data:
+                conn[5].append(data)
+                conn[6] = now
+            else:
+                hostname, ipaddress, port, output = close_connection(fd)
+                if len(output) == 0: # may be caused by xinetd not allowing our address
+                    finished.append((hostname, MKAgentError("Empty output from agent at TCP port %d" % port)))
+                else:
+                    finished.append((hostname, output))
+
+        for fd, conn in connections.items():
+            if now - conn[6] > tcp_connect_timeout:
+                hostname, ipaddress, port, output = close_connection(fd)
+                finished.append((hostname, MKAgentError("Cannot get data from TCP port %s:%d: timed out" %
+                                                        (ipaddress, port))))
+
+        for hostname, output in finished:
+            yield hostname, output
+
+        # Do not blame the agents for the time the caller needed for
+        # processing the yielded data
+        if finished:
+            now = time.time()
+            for conn in connections.values():
+                conn[6] = now
+
+
 # Gets all information about one host so far cached.
 # Returns None if nothing has been stored so far
 def get_cached_hostinfo(hostname):
@@ -843,7 +1033,14 @@ def get_cached_hostinfo(hostname):
 # store complete information about a host
 def store_cached_hostinfo(hostname, info):
     oldinfo = get_cached_hostinfo(hostname)
-    if oldinfo:
+    if oldinfo and isinstance(info, AgentSections):
+        # Keep the sections unparsed: merge the old info into the new one.
+        # dict.items() does not parse pending sections of AgentSections.
+        for key, value in dict.items(oldinfo):
+            if key not in info:
+                info[key] = value
+        g_infocache[hostname] = info
+    elif oldinfo:
         oldinfo.update(info)
         g_infocache[hostname] = oldinfo
     else:
@@ -858,27 +1055,119 @@ def store_cached_checkinfo(hostname, checkname, table):
         g_infocache[hostname] = { checkname: table }
 
 
+# Section of the agent output that has not been parsed yet. It consists
+# of one or more chunks of raw text (a section might appear several
+# times in the agent output), each with the options of its header.
+class UnparsedSection:
+    def __init__(self):
+        self.chunks = []
+
+    def add_chunk(self, text, section_options):
+        self.chunks.append((text, section_options))
+
+    # Splits the lines by the separator and decodes them
+    def parse(self):
+        rows = []
+        for text, section_options in self.chunks:
+            try:
+                separator = chr(int(section_options["sep"]))
+            except:
+                separator = None
+            nostrip = "nostrip" in section_options
+            encoding = section_options.get("encoding")
+
+            for line in text.split("\n"):
+                line = line.rstrip("\r")
+                stripped_line = line.strip()
+                if stripped_line == '':
+                    continue
+                if not nostrip:
+                    line = stripped_line
+
+                if encoding:
+                    line = decode_incoming_string(line, encoding)
+                else:
+                    line = decode_incoming_string(line)
+
+                rows.append(line.split(separator))
+        return rows
+
+
+# Dictionary from section name to the list of rows of that section. The
+# sections are parsed when they are accessed for the first time, so
+# sections not needed by any check are never decoded and split.
+class AgentSections(dict):
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, UnparsedSection):
+            value = value.parse()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return [ (key, self[key]) for key in self.keys() ]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def values(self):
+        return [ self[key] for key in self.keys() ]
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+
+
+# Matches lines that are section headers (<<<...>>>) or piggyback
+# headers (<<<<...>>>>)
+g_agent_header_regex = re.compile("^[ \t\r\x0b\x0c]*(<<<.*>>>)[ \t\r\x0b\x0c]*$", re.M)
+
 # Split agent output in chunks, splits lines by whitespaces.
 # Returns a tuple of:
-# 1. A dictionary from "sectionname" to a list of rows
+# 1. A dictionary from "sectionname" to a list of rows (AgentSections)
 # 2. piggy-backed data for other hosts
 # 3. Sections to be persisted for later usage
 # 4. Agent cache information (dict section name -> (cached_at, cache_interval))
-def parse_info(lines, hostname):
-    info = {}
+#
+# Only the header lines are looked at here. The lines of the sections are
+# split and decoded when the section is accessed for the first time.
+def parse_info(output, hostname):
+    info = AgentSections()
     piggybacked = {} # unparsed info for other hosts
     persist = {} # handle sections with option persist(...)
     host = None
-    section = []
+    section = None
     section_options = {}
     agent_cache_info = {}
-    separator = None
-    encoding  = None
-    to_unicode = False
-    for line in lines:
-        line = line.rstrip("\r")
-        stripped_line = line.strip()
-        if stripped_line[:4] == '<<<<' and stripped_line[-4:] == '>>>>':
+
+    # Lines from the end of one header to the beginning of the next one
+    def lines_between(begin, end):
+        if begin >= end:
+            return ""
+        return output[begin:end-1]
+
+    def is_piggyback_header(stripped_line):
+        return stripped_line[:4] == '<<<<' and stripped_line[-4:] == '>>>>'
+
+    headers = [ (match.group(1), match.start(), match.end())
+                for match in g_agent_header_regex.finditer(output) ]
+    nr = -1
+    while nr + 1 < len(headers):
+        nr += 1
+        stripped_line, header_start, header_end = headers[nr]
+        begin = header_end + 1
+        if nr + 1 < len(headers):
+            end = headers[nr + 1][1]
+        else:
+            end = len(output) + 1
+
+        if is_piggyback_header(stripped_line):
             host = stripped_line[4:-4]
             if not host:
                 host = None
@@ -886,12 +1175,23 @@ def parse_info(lines, hostname):
                 host = translate_piggyback_host(hostname, host)
                 if host == hostname:
                     host = None # unpiggybacked "normal" host
-        elif host: # processing data for an other host
-            piggybacked.setdefault(host, []).append(line)
+
+            if host:
+                # Section headers within the piggybacked data are data, too
+                while nr + 1 < len(headers) and not is_piggyback_header(headers[nr + 1][0]):
+                    nr += 1
+                if nr + 1 < len(headers):
+                    end = headers[nr + 1][1]
+                else:
+                    end = len(output) + 1
+                if begin < end:
+                    piggybacked.setdefault(host, []).extend(
+                        [ line.rstrip("\r") for line in lines_between(begin, end).split("\n") ])
+                continue
 
         # Found normal section header
         # section header has format <<<name:opt1(args):opt2:opt3(args)>>>
-        elif stripped_line[:3] == '<<<' and stripped_line[-3:] == '>>>':
+        else:
             section_header = stripped_line[3:-3]
             headerparts = section_header.split(":")
             section_name = headerparts[0]
@@ -905,14 +1205,9 @@ def parse_info(lines, hostname):
                     opt_args = None
                 section_options[opt_name] = opt_args
 
-            section = info.get(section_name, None)
-            if section == None: # section appears in output for the first time
-                section = []
-                info[section_name] = section
-            try:
-                separator = chr(int(section_options["sep"]))
-            except:
-                separator = None
+            if section_name not in info: # section appears in output for the first time
+                dict.__setitem__(info, section_name, UnparsedSection())
+            section = dict.__getitem__(info, section_name)
 
             # Split of persisted section for server-side caching
             if "persist" in section_options:
@@ -920,24 +1215,19 @@ def parse_info(lines, hostname):
                 cached_at = int(time.time()) # Estimate age of the data
                 cache_interval = int(until - cached_at)
                 agent_cache_info[section_name] = (cached_at, cache_interval)
-                persist[section_name] = ( cached_at, until, section )
+                persist[section_name] = ( cached_at, until )
 
             if "cached" in section_options:
                 agent_cache_info[section_name] = tuple(map(int, section_options["cached"].split(",")))
 
-            # The section data might have a different encoding
-            encoding = section_options.get("encoding")
+        # Lines after a section header or after the end of piggybacked
+        # data belong to the current section (if any)
+        if section is not None:
+            section.add_chunk(lines_between(begin, end), section_options)
 
-        elif stripped_line != '':
-            if "nostrip" not in section_options:
-                line = stripped_line
-
-            if encoding:
-                line = decode_incoming_string(line, encoding)
-            else:
-                line = decode_incoming_string(line)
-
-            section.append(line.split(separator))
+    # Persisted sections are stored in parsed form
+    for section_name, (cached_at, until) in persist.items():
+        persist[section_name] = ( cached_at, until, info[section_name] )
 
     return info, piggybacked, persist, agent_cache_info
 
@@ -986,7 +1276,7 @@ def load_item_state(hostname):
     global g_item_state
     filename = counters_directory + "/" + hostname
     try:
-        g_item_state = eval(file(filename).read())
+        g_item_state = read_data_file(filename)
     except:
         # Try old syntax
         try:
@@ -1004,7 +1294,7 @@ def save_item_state(hostname):
         try:
             if not os.path.exists(counters_directory):
                 os.makedirs(counters_directory)
-            file(filename, "w").write("%r\n" % g_item_state)
+            write_data_file(filename, g_item_state)
         except Exception, e:
             import pwd
             username = pwd.getpwuid(os.getuid())[0]
@@ -1599,7 +1889,7 @@ def get_os_info():
 def write_crash_dump_snmp_info(crash_dir, hostname, check_type):
     cachefile = tcp_cache_dir + "/" + hostname + "." + check_type.split(".")[0]
     if os.path.exists(cachefile):
-        file(crash_dir + "/snmp_info", "w").write(file(cachefile).read())
+        file(crash_dir + "/snmp_info", "w").write("%r\n" % read_data_file(cachefile))
 
 
 def write_crash_dump_agent_output(crash_dir, hostname):
@@ -1959,6 +2249,54 @@ def make_utf8(x):
 def i_am_root():
     return os.getuid() == 0
 
+
+# Files containing Python data structures (counters, cached SNMP data,
+# persisted sections, ...) are stored in a compact binary format: a
+# header with a magic string, the format version, a CRC32 checksum and
+# the length of the payload, followed by the marshaled data. Files
+# written by older versions with repr() can still be read. Data that
+# cannot be marshaled (e.g. objects) is written with repr() as well.
+data_file_magic   = "CMKDATA"
+data_file_version = 1
+data_file_header  = struct.Struct("!7sBII")
+
+def serialize_data(data):
+    try:
+        payload = marshal.dumps(data, 2)
+    except ValueError:
+        return "%r\n" % (data,)
+    return data_file_header.pack(data_file_magic, data_file_version,
+                                 zlib.crc32(payload) & 0xffffffff, len(payload)) + payload
+
+
+def deserialize_data(content):
+    if not content.startswith(data_file_magic):
+        return eval(content) # Old repr() format
+
+    if len(content) < data_file_header.size:
+        raise MKGeneralException("Truncated data file header")
+
+    magic, version, checksum, length = data_file_header.unpack_from(content)
+    if version != data_file_version:
+        raise MKGeneralException("Unsupported data file version %d" % version)
+
+    payload = content[data_file_header.size:]
+    if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum:
+        raise MKGeneralException("Corrupted data file (checksum mismatch)")
+    return marshal.loads(payload)
+
+
+def read_data_file(path):
+    return deserialize_data(file(path).read())
+
+
+# Write to a temporary file first and then rename it. This way readers
+# never see partially written files.
+def write_data_file(path, data):
+    tmp_path = path + ".new.%d" % os.getpid()
+    file(tmp_path, "w").write(serialize_data(data))
+    os.rename(tmp_path, path)
+
 # Returns the nodes of a cluster, or None if hostname is
 # not a cluster
 def nodes_of(hostname):
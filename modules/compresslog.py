@@ -30,32 +30,133 @@
 # files again.
 
 
+import gzip
+
 def do_compress_history(args):
     if not args:
-        bail_out("Please specify files to compress.")
+        bail_out("Please specify files or directories to compress.")
+
+    # Directories: compress all history files in it
+    filenames = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for f in sorted(os.listdir(arg)):
+                path = arg.rstrip("/") + "/" + f
+                if os.path.isfile(path) and not is_compressed_history_file(f):
+                    filenames.append(path)
+        else:
+            filenames.append(arg)
+
+    start_time = time.time()
+    num_processes = max(1, min(max_num_processes, os.sysconf("SC_NPROCESSORS_ONLN"), len(filenames)))
+    if opt_debug:
+        num_processes = 1 # do not hide exceptions in a subprocess
+
+    if num_processes == 1:
+        errors = {}
+        for filename in filenames:
+            error = compress_history_file_verbose(filename)
+            if error:
+                errors[filename] = error
+    else:
+        errors = compress_history_files_parallel(filenames, num_processes)
 
-    for filename in args:
+    # Statistics
+    bytes_in, bytes_out = 0, 0
+    for filename in filenames:
+        if filename in errors:
+            continue
         try:
-            verbose("%s..." % filename)
-            compress_history_file(filename, filename + ".compressed")
-            verbose("OK\n")
-        except Exception, e:
-            if opt_debug:
-                raise
-            bail_out(str(e))
+            size_out = os.stat(compressed_history_path(filename)).st_size
+            bytes_in += os.stat(filename).st_size
+            bytes_out += size_out
+        except OSError:
+            pass
+    duration = max(time.time() - start_time, 0.001)
+    sys.stdout.write("Compressed %d files in %.1f sec (%d processes): %s -> %s, saved %s (%.1f%%), %s/sec\n" % (
+        len(filenames) - len(errors), duration, num_processes,
+        get_bytes_human_readable(bytes_in), get_bytes_human_readable(bytes_out),
+        get_bytes_human_readable(bytes_in - bytes_out),
+        bytes_in and 100.0 * (bytes_in - bytes_out) / bytes_in or 0.0,
+        get_bytes_human_readable(bytes_in / duration)))
+
+    if errors:
+        bail_out("\n".join([ "%s: %s" % e for e in sorted(errors.items()) ]))
+
+
+def is_compressed_history_file(filename):
+    return filename.endswith(".compressed") or filename.endswith(".compressed.gz")
+
+
+def compressed_history_path(filename):
+    if opt_compress_gzip:
+        return filename + ".compressed.gz"
+    else:
+        return filename + ".compressed"
+
+
+# Returns None or the error message
+def compress_history_file_verbose(filename):
+    try:
+        compress_history_file(filename, compressed_history_path(filename))
+        verbose("%s...OK\n" % filename)
+    except Exception, e:
+        if opt_debug:
+            raise
+        verbose("%s...failed\n" % filename)
+        return str(e)
+
+
+# Each process compresses one file at a time. The processes report their
+# errors via their exit code and stderr. Returns a dict from the names of
+# the failed files to the errors.
+def compress_history_files_parallel(filenames, num_processes):
+    errors = {}
+    running = {}
+    todo = filenames[::-1]
+    while todo or running:
+        while todo and len(running) < num_processes:
+            filename = todo.pop()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                exit_code = 0
+                try:
+                    error = compress_history_file_verbose(filename)
+                    if error:
+                        sys.stderr.write("%s: %s\n" % (filename, error))
+                        exit_code = 1
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(exit_code)
+            running[pid] = filename
+
+        pid, status = os.wait()
+        filename = running.pop(pid, None)
+        if filename and status != 0:
+            errors[filename] = "compression failed"
+    return errors
 
 
 def compress_history_file(input_path, output_path):
     known_services = {}
     machine_state = "START"
 
-    output = file(output_path, "w")
-    for line in file(input_path):
+    if output_path.endswith(".gz"):
+        output = gzip.open(output_path, "w")
+    else:
+        output = file(output_path, "w", 1024 * 1024)
+
+    debug_lines = opt_verbose >= 2
+    for line in file(input_path, "r", 1024 * 1024):
         skip_this_line = False
         timestamp = int(line[1:11])
         line_type, host, service = parse_history_line(line)
 
-        vverbose("%s  (%s) %s / %s / %s\n" % (line, machine_state, line_type, host, service))
+        if debug_lines:
+            vverbose("%s  (%s) %s / %s / %s\n" % (line, machine_state, line_type, host, service))
 
         if line_type == "RESTART" or line_type == "LOGGING_INITIAL":
             if machine_state != "START":
@@ -109,6 +210,8 @@ def compress_history_file(input_path, output_path):
         if not skip_this_line:
             output.write(line)
 
+    output.close()
+
 
 def parse_history_line(line):
     command = get_line_command(line)
@@ -129,7 +232,7 @@ def parse_history_line(line):
 
 
 def get_host_service_from_history_line(command, line):
-    arguments = line.split(":")[1].strip().split(";")
+    arguments = line.split(":", 2)[1].strip().split(";")
     if "HOST" in command:
         return arguments[0], None
     else:
@@ -138,7 +241,7 @@ def get_host_service_from_history_line(command, line):
 
 def get_line_command(line):
     if ":" in line:
-        return line.split(":")[0].split("]")[1].strip()
+        return line.split(":", 1)[0].split("]")[1].strip()
     else:
         return line.split("]")[1].strip()
 
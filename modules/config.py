@@ -35,6 +35,7 @@ snmp_ports                         = [] # UDP ports used for SNMP
 tcp_connect_timeout                = 5.0
 use_dns_cache                      = True # prevent DNS by using own cache file
 delay_precompile                   = False  # delay Python compilation to Nagios execution
+precompile_num_processes           = 0      # number of parallel processes for precompiling (0: one per CPU)
 restart_locking                    = "abort" # also possible: "wait", None
 check_submission                   = "file" # alternative: "pipe"
 aggr_summary_hostname              = "%s-s"
@@ -50,6 +51,8 @@ check_mk_perfdata_with_times       = True
 debug_log                          = False # deprecated
 monitoring_host                    = None # deprecated
 max_num_processes                  = 50
+check_batch_max_connections        = 100 # parallel agent connections during cmk --check-batch
+keepalive_fork_workers             = False # keepalive mode: handle each check in a forked worker
 fallback_agent_output_encoding     = 'latin1'
 
 # SNMP communities and encoding
@@ -57,6 +60,7 @@ has_inline_snmp                    = False # is set to True by inline_snmp modul
 use_inline_snmp                    = True
 snmp_limit_oid_range               = [] # Ruleset to recduce fetched OIDs of a check, only inline SNMP
 record_inline_snmp_stats           = False
+use_snmp_scan_cache                = True # reuse SNMP scan results of devices with identical fingerprint
 snmp_default_community             = 'public'
 snmp_communities                   = []
 snmp_timing                        = []
@@ -93,6 +97,7 @@ service_dependency_template        = 'check_mk'
 default_host_group                 = 'check_mk'
 generate_hostconf                  = True
 generate_dummy_commands            = True
+incremental_core_config            = True # reuse the unchanged host parts of the Nagios objects file
 dummy_check_commandline            = 'echo "ERROR - you did an active check on this service - please disable active checks" && exit 1'
 nagios_illegal_chars               = '`;~!$%^&*|\'"<>?,()='
 
@@ -115,6 +120,7 @@ snmpv2c_hosts                        = []
 snmp_without_sys_descr               = []
 snmpv3_contexts                      = []
 usewalk_hosts                        = []
+snmp_table_walk_hosts                = [] # fetch all columns of an SNMP table with one walk
 dyndns_hosts                         = [] # use host name as ip address for these hosts
 primary_address_family               = []
 ignored_checktypes                   = [] # exclude from inventory
@@ -61,25 +61,42 @@ def do_discovery(hostnames, check_types, only_new):
     hostnames = list(set([ h for h in hostnames if not is_cluster(h) ]))
     hostnames.sort()
 
-    # Now loop through all hosts
-    for hostname in hostnames:
-        try:
-            verbose(tty_bold + hostname + tty_normal + ":\n")
-            if opt_debug:
-                on_error = "raise"
-            else:
-                on_error = "warn"
-            do_discovery_for(hostname, check_types, only_new, use_caches, on_error)
-            verbose("\n")
-        except Exception, e:
-            if opt_debug:
-                raise
-            verbose(" -> Failed: %s\n" % e)
+    if opt_debug:
+        on_error = "raise"
+    else:
+        on_error = "warn"
+
+    # The discovery itself is done in parallel processes. The autochecks
+    # are written here.
+    def discover(hostname):
+        return discover_autochecks_for(hostname, check_types, only_new, use_caches, on_error)
+
+    def save_result(hostname, result, output, error):
+        verbose(tty_bold + hostname + tty_normal + ":\n")
+        verbose(output)
+        if error is not None:
+            verbose(" -> Failed: %s\n" % error)
+            return
+
+        final_items, stats = result
+        save_autochecks_file(hostname, final_items)
+
+        found_check_types = stats.keys()
+        found_check_types.sort()
+        if found_check_types:
+            for check_type in found_check_types:
+                verbose("  %s%3d%s %s\n" % (tty_green + tty_bold, stats[check_type], tty_normal, check_type))
+        else:
+            verbose("  nothing%s\n" % (only_new and " new" or ""))
+        verbose("\n")
 
-        cleanup_globals()
+    run_parallel_discovery(hostnames, discover, save_result)
 
 
-def do_discovery_for(hostname, check_types, only_new, use_caches, on_error):
+# Computes the new autochecks of a host for cmk -I and cmk -II. Returns
+# the pair of the list of autocheck items and a dict with the number of
+# new items per check type.
+def discover_autochecks_for(hostname, check_types, only_new, use_caches, on_error):
     # Usually we disable SNMP scan if cmk -I is used without a list of
     # explicity hosts. But for host that have never been service-discovered
     # yet (do not have autochecks), we enable SNMP scan.
@@ -121,15 +138,7 @@ def do_discovery_for(hostname, check_types, only_new, use_caches, on_error):
     for (check_type, item), paramstring in result.items():
         final_items.append((check_type, item, paramstring))
     final_items.sort()
-    save_autochecks_file(hostname, final_items)
-
-    found_check_types = stats.keys()
-    found_check_types.sort()
-    if found_check_types:
-        for check_type in found_check_types:
-            verbose("  %s%3d%s %s\n" % (tty_green + tty_bold, stats[check_type], tty_normal, check_type))
-    else:
-        verbose("  nothing%s\n" % (only_new and " new" or ""))
+    return final_items, stats
 
 
 # determine changed services on host.
@@ -149,49 +158,9 @@ def discover_on_host(mode, hostname, do_snmp_scan, use_caches, on_error="ignore"
     err = None
 
     try:
-        # in "refresh" mode we first need to remove all previously discovered
-        # checks of the host, so that get_host_services() does show us the
-        # new discovered check parameters.
+        new_items = discover_changed_autochecks(mode, hostname, do_snmp_scan, use_caches, on_error, counts)
         if mode == "refresh":
             counts["removed"] += remove_autochecks_of(hostname) # this is cluster-aware!
-
-        # Compute current state of new and existing checks
-        services = get_host_services(hostname, use_caches=use_caches,
-                                        do_snmp_scan=do_snmp_scan, on_error=on_error)
-
-        # Create new list of checks
-        new_items = {}
-        for (check_type, item), (check_source, paramstring) in services.items():
-            if check_source in ("custom", "legacy", "active", "manual"):
-                continue # this is not an autocheck or ignored and currently not checked
-                # Note discovered checks that are shadowed by manual checks will vanish
-                # that way.
-
-            if check_source in ("new"):
-                if mode in ("new", "fixall", "refresh"):
-                    counts["added"] += 1
-                    new_items[(check_type, item)] = paramstring
-
-            elif check_source in ("old", "ignored"):
-                # keep currently existing valid services in any case
-                new_items[(check_type, item)] = paramstring
-                counts["kept"]  += 1
-
-            elif check_source in ("obsolete", "vanished"):
-                # keep item, if we are currently only looking for new services
-                # otherwise fix it: remove ignored and non-longer existing services
-                if mode not in ("fixall", "remove"):
-                    new_items[(check_type, item)] = paramstring
-                    counts["kept"] += 1
-                else:
-                    counts["removed"] += 1
-
-            # Silently keep clustered services
-            elif check_source.startswith("clustered_"):
-                new_items[(check_type, item)] = paramstring
-
-            else:
-                raise MKGeneralException("Unknown check source '%s'" % check_source)
         set_autochecks_of(hostname, new_items)
 
     except Exception, e:
@@ -201,6 +170,57 @@ def discover_on_host(mode, hostname, do_snmp_scan, use_caches, on_error="ignore"
     return [counts["added"], counts["removed"], counts["kept"], counts["added"] + counts["kept"]], err
 
 
+# Computes the new autochecks of a host for discover_on_host(). Returns a
+# dict from (check_type, item) to the parameter string. The number of
+# added, removed and kept services is counted in counts. Nothing is
+# changed on disk: in "refresh" mode the caller has to remove the
+# autochecks of the host with remove_autochecks_of() and count them
+# as removed before saving the new ones.
+def discover_changed_autochecks(mode, hostname, do_snmp_scan, use_caches, on_error, counts):
+    # in "refresh" mode the previously discovered checks of the host must
+    # not be taken into account, so that get_host_services() does show us
+    # the new discovered check parameters.
+    services = get_host_services(hostname, use_caches=use_caches,
+                                 do_snmp_scan=do_snmp_scan, on_error=on_error,
+                                 ignore_autochecks=mode == "refresh")
+
+    # Create new list of checks
+    new_items = {}
+    for (check_type, item), (check_source, paramstring) in services.items():
+        if check_source in ("custom", "legacy", "active", "manual"):
+            continue # this is not an autocheck or ignored and currently not checked
+            # Note discovered checks that are shadowed by manual checks will vanish
+            # that way.
+
+        if check_source in ("new"):
+            if mode in ("new", "fixall", "refresh"):
+                counts["added"] += 1
+                new_items[(check_type, item)] = paramstring
+
+        elif check_source in ("old", "ignored"):
+            # keep currently existing valid services in any case
+            new_items[(check_type, item)] = paramstring
+            counts["kept"]  += 1
+
+        elif check_source in ("obsolete", "vanished"):
+            # keep item, if we are currently only looking for new services
+            # otherwise fix it: remove ignored and non-longer existing services
+            if mode not in ("fixall", "remove"):
+                new_items[(check_type, item)] = paramstring
+                counts["kept"] += 1
+            else:
+                counts["removed"] += 1
+
+        # Silently keep clustered services
+        elif check_source.startswith("clustered_"):
+            new_items[(check_type, item)] = paramstring
+
+        else:
+            raise MKGeneralException("Unknown check source '%s'" % check_source)
+
+    return new_items
+
+
 #.
 #   .--Discovery Check-----------------------------------------------------.
 #   |           ____  _                   _               _                |
@@ -359,6 +379,10 @@ def set_rediscovery_flag(hostname, need_rediscovery):
 # Run the discovery queued by check_discovery() - if any
 marked_host_discovery_timeout = 120
 
+# Maximum time in seconds the discovery of one host may take when running
+# the discovery of several hosts in parallel processes
+discovery_host_timeout = 600
+
 def discover_marked_hosts():
     verbose("Doing discovery for all marked hosts:\n")
 
@@ -407,52 +431,82 @@ def discover_marked_hosts():
         verbose("  Nothing to do. No hosts marked by discovery check.\n")
         return
 
-    activation_required = False
+    activation_required = [ False ]
 
+    # have to do hosts one-by-one because each could have a different configuration
+    rediscovery_params = {}
     for hostname in hosts:
-        verbose("%s%s%s:\n" % (tty_bold, hostname, tty_normal))
         host_flag_path = autodiscovery_dir + "/" + hostname
 
         if hostname not in all_configured_hosts():
+            verbose("%s%s%s:\n" % (tty_bold, hostname, tty_normal))
             os.remove(host_flag_path)
             verbose("  Skipped. Host does not exist in configuration. Removing mark.\n")
             continue
 
-        if time.time() > end_time_ts:
-            warning("  Timeout of %d seconds reached. Lets do the remaining hosts next time." % marked_host_discovery_timeout)
-            break
-
-        # have to do hosts one-by-one because each could have a different configuration
         params = discovery_check_parameters(hostname) or default_discovery_check_parameters()
         why_not = may_rediscover(params)
         if not why_not:
-            redisc_params = params["inventory_rediscovery"]
-            verbose("  Doing discovery with mode '%s'...\n" % mode_table[redisc_params["mode"]])
-            result, error = discover_on_host(mode_table[redisc_params["mode"]], hostname,
-                                             params["inventory_check_do_scan"], True)
-            if error is not None:
-                if error:
-                    verbose("failed: %s\n" % error)
-                else:
-                    # for offline hosts the error message is empty. This is to remain
-                    # compatible with the automation code
-                    verbose("  failed: host is offline\n")
-            else:
-                new_services, removed_services, kept_services, total_services = result
-                if new_services == 0 and removed_services == 0 and kept_services == total_services:
-                    verbose("  nothing changed.\n")
-                else:
-                    verbose("  %d new, %d removed, %d kept, %d total services.\n" % (tuple(result)))
-                    if redisc_params["activation"]:
-                        activation_required = True
-
-            # delete the file even in error case, otherwise we might be causing the same error
-            # every time the cron job runs
-            os.remove(host_flag_path)
+            rediscovery_params[hostname] = params
         else:
+            verbose("%s%s%s:\n" % (tty_bold, hostname, tty_normal))
             verbose("  skipped: %s\n" % why_not)
 
-    if activation_required:
+    def discover(hostname):
+        params = rediscovery_params[hostname]
+        if hostname not in all_active_realhosts():
+            return None
+        counts = { "added" : 0, "removed" : 0, "kept" : 0 }
+        new_items = discover_changed_autochecks(mode_table[params["inventory_rediscovery"]["mode"]],
+                             hostname, params["inventory_check_do_scan"], True, "ignore", counts)
+        return counts, new_items
+
+    def save_result(hostname, result, output, error):
+        redisc_params = rediscovery_params[hostname]["inventory_rediscovery"]
+        verbose("%s%s%s:\n" % (tty_bold, hostname, tty_normal))
+        verbose("  Doing discovery with mode '%s'...\n" % mode_table[redisc_params["mode"]])
+        verbose(output)
+
+        if error is None and result is not None:
+            counts, new_items = result
+            try:
+                if mode_table[redisc_params["mode"]] == "refresh":
+                    counts["removed"] += remove_autochecks_of(hostname)
+                set_autochecks_of(hostname, new_items)
+            except Exception, e:
+                if opt_debug:
+                    raise
+                error = str(e)
+
+        if error is not None:
+            verbose("failed: %s\n" % error)
+        elif result is None:
+            # for offline hosts the error message is empty. This is to remain
+            # compatible with the automation code
+            verbose("  failed: host is offline\n")
+        else:
+            new_services, removed_services, kept_services = \
+                counts["added"], counts["removed"], counts["kept"]
+            total_services = new_services + kept_services
+            if new_services == 0 and removed_services == 0 and kept_services == total_services:
+                verbose("  nothing changed.\n")
+            else:
+                verbose("  %d new, %d removed, %d kept, %d total services.\n" %
+                        (new_services, removed_services, kept_services, total_services))
+                if redisc_params["activation"]:
+                    activation_required[0] = True
+
+        # delete the file even in error case, otherwise we might be causing the same error
+        # every time the cron job runs
+        os.remove(autodiscovery_dir + "/" + hostname)
+
+    left_over = run_parallel_discovery(sorted(rediscovery_params.keys()), discover, save_result,
+                                       deadline=end_time_ts)
+    if left_over:
+        warning("  Timeout of %d seconds reached. Lets do the remaining %d hosts next time." %
+                                               (marked_host_discovery_timeout, len(left_over)))
+
+    if activation_required[0]:
         verbose("\nRestarting monitoring core with updated configuration...\n")
         if monitoring_core == "cmc":
             do_reload()
@@ -526,6 +580,119 @@ def get_info_for_discovery(hostname, ipaddress, section_name, use_caches):
 
     return info
 
+
+# Runs discover_function(hostname) for each of the hosts in up to
+# max_num_processes forked processes. Each process handles one host and
+# passes the result of the function and its verbose output to this
+# process, which calls handle_result(hostname, result, output, error) as
+# soon as a host has finished. error is None in case of success. A host
+# needing more than discovery_host_timeout seconds is being killed. No
+# processes are started after the optional deadline. Returns the list of
+# hosts that have not been handled due to the deadline.
+def run_parallel_discovery(hostnames, discover_function, handle_result, deadline=None):
+    hostnames = list(hostnames)
+    num_processes = min(max(max_num_processes, 1), len(hostnames))
+    num_failed = 0
+
+    # In debug mode exceptions must not be hidden in a subprocess
+    if num_processes <= 1 or opt_debug:
+        while hostnames and (deadline is None or time.time() <= deadline):
+            hostname = hostnames.pop(0)
+            output = cStringIO.StringIO()
+            stdout, sys.stdout = sys.stdout, output
+            try:
+                try:
+                    result, error = discover_function(hostname), None
+                except Exception, e:
+                    if opt_debug:
+                        raise
+                    result, error = None, str(e)
+            finally:
+                sys.stdout = stdout
+            if error is not None:
+                num_failed += 1
+            handle_result(hostname, result, output.getvalue(), error)
+            cleanup_globals()
+        return hostnames
+
+    running = {} # fd -> [ pid, hostname, start time, chunks of output ]
+    num_timeouts = 0
+    num_done = 0
+    while running or (hostnames and (deadline is None or time.time() <= deadline)):
+        while hostnames and len(running) < num_processes \
+              and (deadline is None or time.time() <= deadline):
+            hostname = hostnames.pop(0)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                exit_code = 1
+                try:
+                    try:
+                        # Own process group, so that a timeout also kills
+                        # datasource programs and other children
+                        os.setpgid(0, 0)
+                        sys.stdout = cStringIO.StringIO()
+                        try:
+                            result, error = discover_function(hostname), None
+                        except Exception, e:
+                            result, error = None, str(e)
+                        data = serialize_data((result, sys.stdout.getvalue(), error))
+                        while data:
+                            data = data[os.write(write_fd, data):]
+                        exit_code = 0
+                    except:
+                        pass
+                finally:
+                    os._exit(exit_code)
+
+            os.close(write_fd)
+            try:
+                os.setpgid(pid, pid)
+            except OSError:
+                pass # child has already done this or has already exited
+            running[read_fd] = [ pid, hostname, time.time(), [] ]
+
+        if not running:
+            break
+
+        readable = select.select(running.keys(), [], [], 1)[0]
+        for fd in readable:
+            chunk = os.read(fd, 65536)
+            if chunk:
+                running[fd][3].append(chunk)
+                continue
+
+            pid, hostname, started, chunks = running.pop(fd)
+            os.close(fd)
+            os.waitpid(pid, 0)
+            try:
+                result, output, error = deserialize_data("".join(chunks))
+            except Exception:
+                result, output, error = None, "", "discovery process died unexpectedly"
+            if error is not None:
+                num_failed += 1
+            num_done += 1
+            handle_result(hostname, result, output, error)
+
+        now = time.time()
+        for fd, (pid, hostname, started, chunks) in running.items():
+            if now - started > discovery_host_timeout:
+                os.killpg(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                os.close(fd)
+                del running[fd]
+                num_timeouts += 1
+                num_failed += 1
+                num_done += 1
+                handle_result(hostname, None, "", "timed out after %d seconds" % discovery_host_timeout)
+
+    verbose("Discovered %d hosts with %d processes: %d failed (%d timed out), %d not started.\n" %
+            (num_done, num_processes, num_failed, num_timeouts, len(hostnames)))
+    return hostnames
+
 #.
 #   .--Discovery-----------------------------------------------------------.
 #   |              ____  _                                                 |
@@ -634,6 +801,13 @@ def snmp_scan(hostname, ipaddress, on_error = "ignore", for_inv=False):
         set_oid_cache(hostname, ".1.3.6.1.2.1.1.1.0", "")
         set_oid_cache(hostname, ".1.3.6.1.2.1.1.2.0", "")
 
+    if use_snmp_scan_cache:
+        scan_cache_key = (for_inv, get_single_oid(hostname, ipaddress, ".1.3.6.1.2.1.1.2.0"))
+        scan_cache_entry = find_snmp_scan_cache_entry(hostname, ipaddress, scan_cache_key)
+    else:
+        scan_cache_entry = None
+    read_oids = {}    # all OIDs read by the scan functions with their values
+    scan_results = {} # check type -> result of scan function
 
     found = []
     if for_inv:
@@ -664,9 +838,17 @@ def snmp_scan(hostname, ipaddress, on_error = "ignore", for_inv=False):
             scan_function = None
 
         if scan_function:
+            host_specific = not snmp_scan_function_is_cacheable(scan_function)
+            if scan_cache_entry and check_type in scan_cache_entry[1] and not host_specific:
+                if scan_cache_entry[1][check_type]:
+                    found.append(check_type)
+                    positive_found.append(check_type)
+                continue
+
             try:
                 def oid_function(oid, default_value=None):
                     value = get_single_oid(hostname, ipaddress, oid)
+                    read_oids[oid] = value
                     if value == None:
                         return default_value
                     else:
@@ -678,9 +860,12 @@ def snmp_scan(hostname, ipaddress, on_error = "ignore", for_inv=False):
                                 (check_type, type(result)))
                     elif on_error == "raise":
                         raise MKGeneralException("SNMP Scan aborted.")
+                    result = False
                 elif result:
                     found.append(check_type)
                     positive_found.append(check_type)
+                if not host_specific:
+                    scan_results[check_type] = bool(result)
             except MKGeneralException:
                 # some error messages which we explicitly want to show to the user
                 # should be raised through this
@@ -695,6 +880,9 @@ def snmp_scan(hostname, ipaddress, on_error = "ignore", for_inv=False):
             found.append(check_type)
             default_found.append(check_type)
 
+    if use_snmp_scan_cache and scan_results:
+        update_snmp_scan_cache(scan_cache_key, scan_cache_entry, read_oids, scan_results)
+
     vverbose("   SNMP scan found:       %s%s%s%s\n" % (tty_bold, tty_yellow, " ".join(positive_found), tty_normal))
     if default_found:
         vverbose("   without scan function: %s%s%s%s\n" % (tty_bold, tty_blue, " ".join(default_found), tty_normal))
@@ -703,6 +891,133 @@ def snmp_scan(hostname, ipaddress, on_error = "ignore", for_inv=False):
     found.sort()
     return found
 
+
+# Cache of the SNMP scan results. Devices of the same model usually give
+# the same answers to the scan functions. The results of the scan functions
+# are stored per model (sysObjectID) together with the values of all OIDs
+# that have been read by the scan functions (often including sysDescr).
+# Scan functions that might depend on the host are always executed. The
+# cache is dropped when the checks have changed.
+snmp_scan_cache_file = var_dir + "/snmp_scan_cache"
+snmp_scan_cache_max_entries = 20   # per sysObjectID
+snmp_scan_cache_max_models = 1000  # least recently updated ones are dropped
+g_snmp_scan_cache = None
+
+# Global names a cacheable scan function may use
+snmp_scan_cacheable_names = set([ "True", "False", "None", "int", "float",
+                                  "str", "len", "any", "all" ])
+g_snmp_scan_cacheable = {}
+
+# The result of a scan function can only be shared between hosts if it
+# depends on nothing but the OIDs it reads. This is only assumed for
+# functions that access no global names except some builtins. Helper
+# functions (e.g. if64_scan_function) might look at g_hostname or the
+# host configuration, so such scan functions are executed for each host.
+def snmp_scan_function_is_cacheable(scan_function):
+    try:
+        return g_snmp_scan_cacheable[scan_function]
+    except KeyError:
+        pass
+
+    def uses_only_cacheable_names(code):
+        global_opcodes = [ opcode.opmap["LOAD_GLOBAL"], opcode.opmap["LOAD_NAME"] ]
+        bytecode = code.co_code
+        i = 0
+        extended_arg = 0
+        while i < len(bytecode):
+            op = ord(bytecode[i])
+            if op < opcode.HAVE_ARGUMENT:
+                i += 1
+                continue
+            arg = ord(bytecode[i+1]) + ord(bytecode[i+2]) * 256 + extended_arg
+            i += 3
+            if op == opcode.EXTENDED_ARG:
+                extended_arg = arg * 65536
+                continue
+            extended_arg = 0
+            if op in global_opcodes and code.co_names[arg] not in snmp_scan_cacheable_names:
+                return False
+
+        # Nested code objects: lambdas, generator expressions, ...
+        for const in code.co_consts:
+            if type(const) == type(code) and not uses_only_cacheable_names(const):
+                return False
+        return True
+
+    cacheable = not scan_function.func_closure \
+                and not scan_function.func_defaults \
+                and uses_only_cacheable_names(scan_function.func_code)
+    g_snmp_scan_cacheable[scan_function] = cacheable
+    return cacheable
+
+def load_snmp_scan_cache():
+    try:
+        cache = read_data_file(snmp_scan_cache_file)
+        if cache["checks"] == checks_fingerprint() and "models" in cache:
+            return cache
+    except Exception:
+        pass
+    return { "checks" : checks_fingerprint(), "models" : {} }
+
+
+# Returns the cache entry matching the device or None. An entry is a pair
+# of the OIDs read by the scan functions with their values and the results
+# of the scan functions. The cache file is only read once per process.
+def find_snmp_scan_cache_entry(hostname, ipaddress, key):
+    global g_snmp_scan_cache
+    if g_snmp_scan_cache == None:
+        g_snmp_scan_cache = load_snmp_scan_cache()
+
+    entries = g_snmp_scan_cache["models"].get(key, (0, []))[1]
+    needed_oids = set([])
+    for read_oids, scan_results in entries:
+        needed_oids.update(read_oids.keys())
+    prefetch_single_oids(hostname, ipaddress, sorted(needed_oids))
+
+    for entry in entries:
+        read_oids, scan_results = entry
+        for oid, value in read_oids.items():
+            if get_single_oid(hostname, ipaddress, oid) != value:
+                break
+        else:
+            vverbose("   Using cached SNMP scan results.\n")
+            return entry
+    return None
+
+
+def update_snmp_scan_cache(key, entry, read_oids, scan_results):
+    global g_snmp_scan_cache
+    if entry:
+        # Scan functions of new checks have been executed in addition
+        new_entry = (dict(entry[0].items() + read_oids.items()),
+                     dict(entry[1].items() + scan_results.items()))
+        if new_entry == tuple(entry):
+            return
+    else:
+        new_entry = (read_oids, scan_results)
+
+    try:
+        # Read the cache again. Other processes might have changed it meanwhile.
+        cache = load_snmp_scan_cache()
+        g_snmp_scan_cache = cache
+        models = cache["models"]
+        entries = models.get(key, (0, []))[1]
+        if new_entry in entries:
+            return # already added by another process
+
+        entries = [ e for e in entries if e[0] != new_entry[0] and (not entry or e[0] != entry[0]) ]
+        models[key] = (time.time(), ([ new_entry ] + entries)[:snmp_scan_cache_max_entries])
+
+        if len(models) > snmp_scan_cache_max_models:
+            by_age = sorted([ (updated, k) for k, (updated, e) in models.items() ])
+            for updated, k in by_age[:len(models) - snmp_scan_cache_max_models]:
+                del models[k]
+
+        write_data_file(snmp_scan_cache_file, cache)
+    except Exception:
+        if opt_debug:
+            raise
+
 def discover_check_type(hostname, ipaddress, check_type, use_caches, on_error):
     # Skip this check type if is ignored for that host
     if service_ignored(hostname, check_type, None):
@@ -828,16 +1143,22 @@ def discoverable_check_types(what): # snmp, tcp, all
 #    "obsolete"      : Discovered by vanished check is meanwhile ignored via ignored_services
 #    "clustered_new" : New service found on a node that belongs to a cluster
 #    "clustered_old" : Old service found on a node that belongs to a cluster
-# This function is cluster-aware
-def get_host_services(hostname, use_caches, do_snmp_scan, on_error, ipaddress=None):
+# This function is cluster-aware. With ignore_autochecks the services
+# which remove_autochecks_of() would remove are not looked at.
+def get_host_services(hostname, use_caches, do_snmp_scan, on_error, ipaddress=None,
+                      ignore_autochecks=False):
     if is_cluster(hostname):
-        return get_cluster_services(hostname, use_caches, do_snmp_scan, on_error)
+        return get_cluster_services(hostname, use_caches, do_snmp_scan, on_error,
+                                    ignore_autochecks)
     else:
-        return get_node_services(hostname, ipaddress, use_caches, do_snmp_scan, on_error)
+        return get_node_services(hostname, ipaddress, use_caches, do_snmp_scan, on_error,
+                                 ignore_autochecks)
 
 
-# Part of get_node_services that deals with discovered services
-def get_discovered_services(hostname, ipaddress, use_caches, do_snmp_scan, on_error):
+# Part of get_node_services that deals with discovered services. Existing
+# autochecks belonging to the host ignore_autochecks_of are skipped.
+def get_discovered_services(hostname, ipaddress, use_caches, do_snmp_scan, on_error,
+                            ignore_autochecks_of=None):
     # Create a dict from check_type/item to check_source/paramstring
     services = {}
 
@@ -849,6 +1170,11 @@ def get_discovered_services(hostname, ipaddress, use_caches, do_snmp_scan, on_er
     # Match with existing items -> "old" and "vanished"
     old_items = parse_autochecks_file(hostname)
     for check_type, item, paramstring in old_items:
+        if ignore_autochecks_of and \
+           ignore_autochecks_of == host_of_clustered_service(hostname,
+                                         service_description(check_type, item)):
+            continue
+
         if (check_type, item) not in services:
             services[(check_type, item)] = ("vanished", paramstring)
         else:
@@ -857,8 +1183,10 @@ def get_discovered_services(hostname, ipaddress, use_caches, do_snmp_scan, on_er
     return services
 
 # Do the actual work for a non-cluster host or node
-def get_node_services(hostname, ipaddress, use_caches, do_snmp_scan, on_error):
-    services = get_discovered_services(hostname, ipaddress, use_caches, do_snmp_scan, on_error)
+def get_node_services(hostname, ipaddress, use_caches, do_snmp_scan, on_error,
+                      ignore_autochecks=False):
+    services = get_discovered_services(hostname, ipaddress, use_caches, do_snmp_scan, on_error,
+                                       ignore_autochecks and hostname or None)
 
     # Identify clustered services
     for (check_type, item), (check_source, paramstring) in services.items():
@@ -911,14 +1239,15 @@ def merge_manual_services(services, hostname):
     return services
 
 # Do the work for a cluster
-def get_cluster_services(hostname, use_caches, with_snmp_scan, on_error):
+def get_cluster_services(hostname, use_caches, with_snmp_scan, on_error, ignore_autochecks=False):
     nodes = nodes_of(hostname)
 
     # Get services of the nodes. We are only interested in "old", "new" and "vanished"
     # From the states and parameters of these we construct the final state per service.
     cluster_items = {}
     for node in nodes:
-        services = get_discovered_services(node, None, use_caches, with_snmp_scan, on_error)
+        services = get_discovered_services(node, None, use_caches, with_snmp_scan, on_error,
+                                           ignore_autochecks and hostname or None)
         for (check_type, item), (check_source, paramstring) in services.items():
             descr = service_description(check_type, item)
             if hostname == host_of_clustered_service(node, descr):
@@ -1082,7 +1411,7 @@ def read_autochecks_of(hostname, world="config"):
     if not os.path.exists(filepath):
         return []
     try:
-        autochecks_raw = eval(file(filepath).read())
+        autochecks_raw = eval_autochecks_file(hostname, filepath)
     except SyntaxError,e:
         if opt_verbose or opt_debug:
             sys.stderr.write("Syntax error in file %s: %s\n" % (filepath, e))
@@ -1111,6 +1440,16 @@ def read_autochecks_of(hostname, world="config"):
     return autochecks
 
 
+# Matches an autochecks line with a plain check type and item. The
+# rest of the line is the parameter string. Lines of the legacy format
+# with the host name in the first column do not match: there the check
+# type would be followed by a literal item and another comma, which is
+# no valid parameter string.
+regex_autochecks_item = r"""(?:None|-?\d+|u?'(?:[^'\\]|\\.)*'|u?"(?:[^"\\]|\\.)*")"""
+regex_autochecks_line = re.compile(r"""^\(\s*('[^'\\]*'|"[^"\\]*")\s*,\s*"""
+                                   r"""(%s)\s*,(?!\s*%s\s*,)(.*)\)$""" %
+                                   (regex_autochecks_item, regex_autochecks_item))
+
 # Read autochecks, but do not compute final check parameters,
 # also return a forth column with the raw string of the parameters.
 # Returns a table with three columns:
@@ -1168,30 +1507,44 @@ def parse_autochecks_file(hostname):
 
             if line.endswith(","):
                 line = line[:-1]
-            line = line[1:-1] # drop brackets
 
-            # First try old format - with hostname
-            parts = []
-            while True:
-                try:
-                    part, line = split_python_tuple(line)
-                    parts.append(part)
-                except:
-                    break
-            if len(parts) == 4:
-                parts = parts[1:] # drop hostname, legacy format with host in first column
-            elif len(parts) != 3:
-                raise Exception("Invalid number of parts: %d" % len(parts))
-
-            checktypestring, itemstring, paramstring = parts
-
-            item = eval(itemstring)
+            # Lines written by save_autochecks_file() can be split without
+            # looking at each character. The legacy format with the host
+            # name in the first column needs the slow way.
+            match = regex_autochecks_line.match(line)
+            if match:
+                check_type = match.group(1)[1:-1]
+                itemstring = match.group(2)
+                paramstring = match.group(3).strip()
+            else:
+                line = line[1:-1] # drop brackets
+
+                # First try old format - with hostname
+                parts = []
+                while True:
+                    try:
+                        part, line = split_python_tuple(line)
+                        parts.append(part)
+                    except:
+                        break
+                if len(parts) == 4:
+                    parts = parts[1:] # drop hostname, legacy format with host in first column
+                elif len(parts) != 3:
+                    raise Exception("Invalid number of parts: %d" % len(parts))
+
+                checktypestring, itemstring, paramstring = parts
+                check_type = eval(checktypestring)
+
+            if itemstring == "None":
+                item = None
+            else:
+                item = eval(itemstring)
             # With Check_MK 1.2.7i3 items are now defined to be unicode strings. Convert
             # items from existing autocheck files for compatibility. TODO remove this one day
             if type(item) == str:
                 item = decode_incoming_string(item)
 
-            table.append((eval(checktypestring), item, paramstring))
+            table.append((check_type, item, paramstring))
         except:
             if opt_debug:
                 raise
@@ -1199,6 +1552,92 @@ def parse_autochecks_file(hostname):
     return table
 
 
+# Cache of the compiled autochecks files of all hosts. It is used while
+# creating the configuration of the core and while precompiling the host
+# checks, where the autochecks of all hosts are needed. The cache is loaded
+# with a single read. Entries are only used if the stat() of the autochecks
+# file has not changed.
+autochecks_cache_file = var_dir + "/autochecks_cache"
+g_autochecks_cache = None
+g_autochecks_cache_changed = set([]) # hosts with new entries
+
+def load_autochecks_cache():
+    global g_autochecks_cache
+    if g_autochecks_cache != None:
+        return
+    try:
+        cache = read_data_file(autochecks_cache_file)
+        if cache["python"] != sys.version: # code objects are not portable
+            raise MKGeneralException("Python version has changed")
+        g_autochecks_cache = cache["hosts"]
+    except Exception:
+        g_autochecks_cache = {}
+
+
+def save_autochecks_cache():
+    global g_autochecks_cache_changed
+    if not g_autochecks_cache_changed:
+        return
+
+    # Forget about hosts that do not exist anymore
+    hosts = set(all_active_realhosts())
+    for hostname in g_autochecks_cache.keys():
+        if hostname not in hosts:
+            del g_autochecks_cache[hostname]
+
+    try:
+        write_data_file(autochecks_cache_file, {
+            "python" : sys.version,
+            "hosts"  : g_autochecks_cache,
+        })
+    except Exception:
+        if opt_debug:
+            raise
+    g_autochecks_cache_changed = set([])
+
+
+# Returns the entries of the autochecks cache that have been added by
+# this process, so that a worker process can pass them to its parent.
+def new_autochecks_cache_entries():
+    return dict([ (hostname, g_autochecks_cache[hostname])
+                  for hostname in g_autochecks_cache_changed
+                  if hostname in g_autochecks_cache ])
+
+
+def add_autochecks_cache_entries(entries):
+    g_autochecks_cache.update(entries)
+    g_autochecks_cache_changed.update(entries.keys())
+
+
+# The autochecks files usually only contain literals. Then the value
+# itself is cached in marshaled form. Otherwise (parameters refer to
+# variables) the compiled file is cached and evaluated each time.
+def eval_autochecks_file(hostname, path):
+    global g_autochecks_cache_changed
+    if g_autochecks_cache == None:
+        return eval(file(path).read())
+
+    st = os.stat(path)
+    signature = (st.st_ino, st.st_mtime, st.st_size)
+    entry = g_autochecks_cache.get(hostname)
+    if not entry or entry[0] != signature:
+        code = compile(file(path).read(), path, "eval")
+        if code.co_names:
+            entry = signature, "code", code
+        else:
+            entry = signature, "value", marshal.dumps(eval(code))
+        # Files changed during the last seconds might be changed again
+        # without changing their mtime. Do not remember them.
+        if time.time() - st.st_mtime > 2:
+            g_autochecks_cache[hostname] = entry
+            g_autochecks_cache_changed.add(hostname)
+
+    if entry[1] == "code":
+        return eval(entry[2])
+    else:
+        return marshal.loads(entry[2])
+
+
 def has_autochecks(hostname):
     return os.path.exists(autochecksdir + "/" + hostname + ".mk")
 
@@ -55,7 +55,13 @@ def event_keepalive(event_function, log_function, call_every_loop=None, loop_int
             # has been sent. We do this by setting the environment variable
             # CMK_EVENT_RESTART=1
 
-            if event_data_available(loop_interval):
+            # loop_interval may also be a function computing the interval
+            if callable(loop_interval):
+                timeout = loop_interval()
+            else:
+                timeout = loop_interval
+
+            if event_data_available(timeout):
                 if last_config_timestamp != config_timestamp():
                     log_function("Configuration has changed. Restarting myself.")
                     if shutdown_function:
@@ -282,22 +288,10 @@ def complete_raw_context(raw_context, with_dump, event_log):
 
 
 
+# Returns None if the rule matches, otherwise the reason why not. The
+# conditions are listed in event_rule_conditions below.
 def event_match_rule(rule, context):
-    return \
-        event_match_folder(rule, context)                or \
-        event_match_hosttags(rule, context)              or \
-        event_match_hostgroups(rule, context)            or \
-        event_match_servicegroups(rule, context)         or \
-        event_match_contacts(rule, context)              or \
-        event_match_contactgroups(rule, context)         or \
-        event_match_hosts(rule, context)                 or \
-        event_match_exclude_hosts(rule, context)         or \
-        event_match_services(rule, context)              or \
-        event_match_exclude_services(rule, context)      or \
-        event_match_plugin_output(rule, context)         or \
-        event_match_checktype(rule, context)             or \
-        event_match_timeperiod(rule)                     or \
-        event_match_servicelevel(rule, context)
+    return event_match_compiled_rule(event_rule_matchers(rule), rule, context)
 
 
 def event_match_folder(rule, context):
@@ -436,7 +430,7 @@ def event_match_services(rule, context):
             return "The rule specifies a list of services, but this is a host notification."
         servicelist = rule["match_services"]
         service = context["SERVICEDESC"]
-        if not in_extraconf_servicelist(servicelist, service):
+        if not event_in_servicelist(servicelist, service):
             return "The service's description '%s' dows not match by the list of " \
                    "allowed services (%s)" % (service, ", ".join(servicelist))
 
@@ -446,7 +440,7 @@ def event_match_exclude_services(rule, context):
         return
     excludelist = rule.get("match_exclude_services", [])
     service = context["SERVICEDESC"]
-    if in_extraconf_servicelist(excludelist, service):
+    if event_in_servicelist(excludelist, service):
         return "The service's description '%s' matches the list of excluded services" \
           % context["SERVICEDESC"]
 
@@ -497,6 +491,51 @@ def event_match_servicelevel(rule, context):
             return "The service level %d is not between %d and %d." % (sl, from_sl, to_sl)
 
 
+# The conditions of event_match_rule() together with the rule keys they
+# depend on. Each function returns None if the rule does not have its
+# condition.
+event_rule_conditions = [
+    ( "match_folder",           event_match_folder ),
+    ( "match_hosttags",         event_match_hosttags ),
+    ( "match_hostgroups",       event_match_hostgroups ),
+    ( "match_servicegroups",    event_match_servicegroups ),
+    ( "match_contacts",         event_match_contacts ),
+    ( "match_contactgroups",    event_match_contactgroups ),
+    ( "match_hosts",            event_match_hosts ),
+    ( "match_exclude_hosts",    event_match_exclude_hosts ),
+    ( "match_services",         event_match_services ),
+    ( "match_exclude_services", event_match_exclude_services ),
+    ( "match_plugin_output",    event_match_plugin_output ),
+    ( "match_checktype",        event_match_checktype ),
+    ( "match_timeperiod",       lambda rule, context: event_match_timeperiod(rule) ),
+    ( "match_sl",               event_match_servicelevel ),
+]
+
+# Compile a rule into the list of match functions it really needs. Use
+# this if a rule is matched against many events.
+def event_rule_matchers(rule):
+    return [ matcher for key, matcher in event_rule_conditions if key in rule ]
+
+
+def event_match_compiled_rule(matchers, rule, context):
+    for matcher in matchers:
+        why_not = matcher(rule, context)
+        if why_not:
+            return why_not
+
+
+# Service patterns of rules are converted only once per process
+g_event_service_matchers = {}
+
+def event_in_servicelist(servicelist, service):
+    key = tuple(servicelist)
+    matchers = g_event_service_matchers.get(key)
+    if matchers == None:
+        matchers = convert_pattern_list(servicelist)
+        g_event_service_matchers[key] = matchers
+    return in_servicematcher_list(matchers, service)
+
+
 def add_context_to_environment(plugin_context, prefix):
     for key in plugin_context:
         os.putenv(prefix + key, plugin_context[key].encode('utf-8'))
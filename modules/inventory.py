@@ -25,10 +25,12 @@
 # Boston, MA 02110-1301 USA.
 
 import gzip
+import difflib
 
 inventory_output_dir = var_dir + "/inventory"
 inventory_archive_dir = var_dir + "/inventory_archive"
 inventory_pprint_output = True
+inventory_archive_max_deltas = 20 # archive a complete tree after this number of deltas
 
 #   .--Plugins-------------------------------------------------------------.
 #   |                   ____  _             _                              |
@@ -189,8 +191,7 @@ def do_inv_check(hostname):
         state = 0
 
         if old_timestamp:
-            path = inventory_archive_dir + "/" + hostname + "/%d" % old_timestamp
-            old_tree = eval(file(path).read())
+            old_tree = load_archived_inv_tree(hostname, old_timestamp)
 
             if inv_tree.get("software") != old_tree.get("software"):
                 infotext += ", software changes"
@@ -305,7 +306,11 @@ def save_inv_tree(hostname):
         old_tree = None
         if os.path.exists(path):
             try:
-                old_tree = eval(file(path).read())
+                old_content = file(path).read()
+                if old_content == r + "\n":
+                    old_tree = g_inv_tree # unchanged, no need to parse it
+                else:
+                    old_tree = eval(old_content)
             except:
                 pass
 
@@ -313,12 +318,16 @@ def save_inv_tree(hostname):
             if old_tree:
                 verbose("..changed")
                 old_time = os.stat(path).st_mtime
-                arcdir = "%s/%s" % (inventory_archive_dir, hostname)
-                if not os.path.exists(arcdir):
-                    os.makedirs(arcdir)
-                os.rename(path, arcdir + ("/%d" % old_time))
+                archive_inv_tree(hostname, path, old_tree, old_time, g_inv_tree)
             else:
                 verbose("..new")
+                # The new tree must not become the base of older deltas
+                entries = inv_archive_entries(hostname)
+                if entries and entries[0][1]:
+                    if os.path.exists(path):
+                        archive_current_inv_tree(hostname)
+                    else:
+                        orphan_inv_archive_deltas(hostname)
 
             file(path, "w").write(r + "\n")
             gzip.open(path + ".gz", "w").write(r + "\n")
@@ -328,8 +337,9 @@ def save_inv_tree(hostname):
             verbose("..unchanged")
 
     else:
-        if os.path.exists(path): # Remove empty inventory files. Important for host inventory icon
-            os.remove(path)
+        # Remove empty inventory files. Important for host inventory icon.
+        # The last tree is the base of the archived deltas, so keep it.
+        archive_current_inv_tree(hostname)
         if os.path.exists(path + ".gz"):
             os.remove(path + ".gz")
 
@@ -352,4 +362,156 @@ def run_inv_export_hooks(hostname, tree):
                 raise MKGeneralException("Failed to execute export hook %s: %s" % (
                     hookname, e))
 
+#.
+#   .--Archive-------------------------------------------------------------.
+#   |                    _             _     _                             |
+#   |                   / \   _ __ ___| |__ (_)_   _____                   |
+#   |                  / _ \ | '__/ __| '_ \| \ \ / / _ \                  |
+#   |                 / ___ \| | | (__| | | | |\ V /  __/                  |
+#   |                /_/   \_\_|  \___|_| |_|_| \_/ \___|                  |
+#   |                                                                      |
+#   +----------------------------------------------------------------------+
+#   | The previous inventory trees of a host are kept in the directory     |
+#   | inventory_archive_dir/HOST. A tree is either stored completely in    |
+#   | the file TIMESTAMP or - usually - as delta to the next newer tree in |
+#   | the file TIMESTAMP.delta. After inventory_archive_max_deltas deltas  |
+#   | a complete tree is stored, so that any tree can be restored by       |
+#   | applying a limited number of deltas. The GUI (htdocs/inventory.py)   |
+#   | reads this format, too.                                              |
+#   '----------------------------------------------------------------------'
+
+def archive_inv_tree(hostname, path, old_tree, old_time, new_tree):
+    arcdir = "%s/%s" % (inventory_archive_dir, hostname)
+    if not os.path.exists(arcdir):
+        os.makedirs(arcdir)
+
+    # Several changes within one second: the existing entry is the tree
+    # before old_tree. A complete tree is kept as it is and old_tree is not
+    # archived. A delta is based on old_tree, so it is merged with the
+    # changes to the new tree.
+    arcpath = arcdir + ("/%d" % old_time)
+    if os.path.exists(arcpath):
+        return
+    elif os.path.exists(arcpath + ".delta"):
+        delta = eval(file(arcpath + ".delta").read())
+        older_tree = inv_apply_delta(old_tree, delta)
+        file(arcpath + ".delta", "w").write("%r\n" % (inv_tree_delta(new_tree, older_tree),))
+        return
+
+    recent = inv_archive_entries(hostname)[:inventory_archive_max_deltas - 1]
+    if len(recent) == inventory_archive_max_deltas - 1 \
+       and not [ e for e in recent if not e[1] ]:
+        os.rename(path, arcpath)
+    else:
+        file(arcpath + ".delta", "w").write("%r\n" % (inv_tree_delta(new_tree, old_tree),))
+
+
+# Deltas whose newer tree is lost can never be restored. Rename them,
+# so that they are not applied to an unrelated new tree.
+def orphan_inv_archive_deltas(hostname):
+    arcdir = "%s/%s" % (inventory_archive_dir, hostname)
+    for timestamp, is_delta in inv_archive_entries(hostname):
+        if not is_delta:
+            break
+        arcpath = "%s/%d.delta" % (arcdir, timestamp)
+        os.rename(arcpath, arcpath + ".orphaned")
+        verbose("..orphaned archive entry %d" % timestamp)
+
+
+# Returns a list of pairs of timestamp and a flag whether or not
+# the tree is stored as delta, newest first.
+def inv_archive_entries(hostname):
+    arcdir = "%s/%s" % (inventory_archive_dir, hostname)
+    entries = []
+    if os.path.exists(arcdir):
+        for filename in os.listdir(arcdir):
+            try:
+                if filename.endswith(".delta"):
+                    entries.append((int(filename[:-6]), True))
+                else:
+                    entries.append((int(filename), False))
+            except ValueError:
+                pass
+    entries.sort(reverse=True)
+    return entries
+
+
+def load_archived_inv_tree(hostname, timestamp):
+    entries = inv_archive_entries(hostname)
+    for nr, (ts, is_delta) in enumerate(entries):
+        if ts == int(timestamp):
+            break
+    else:
+        raise MKGeneralException("No archived inventory of %s at %d" % (hostname, timestamp))
+
+    # Begin with the next complete tree, either archived or the current one
+    start = nr
+    while start >= 0 and entries[start][1]:
+        start -= 1
+    if start < 0:
+        tree = eval(file(inventory_output_dir + "/" + hostname).read())
+    else:
+        tree = eval(file("%s/%s/%d" % (inventory_archive_dir, hostname, entries[start][0])).read())
+
+    for ts, is_delta in entries[start+1:nr+1]:
+        delta = eval(file("%s/%s/%d.delta" % (inventory_archive_dir, hostname, ts)).read())
+        tree = inv_apply_delta(tree, delta)
+    return tree
+
+
+# Computes the changes needed to restore the old tree from the new one:
+# ("set", value)   -> replace the node with value
+# ("del",)         -> remove the node from its dict
+# ("dict", deltas) -> change the entries of a dict according to deltas
+# ("list", parts)  -> build the list from parts. These are either
+#                     ("r", start, end) for new[start:end] or
+#                     ("v", items) for items of the old list.
+def inv_tree_delta(new, old):
+    if type(new) == dict and type(old) == dict:
+        deltas = {}
+        for key in new:
+            if key not in old:
+                deltas[key] = ("del",)
+        for key, value in old.items():
+            if key not in new:
+                deltas[key] = ("set", value)
+            elif value != new[key]:
+                deltas[key] = inv_tree_delta(new[key], value)
+        return ("dict", deltas)
+
+    elif type(new) == list and type(old) == list:
+        matcher = difflib.SequenceMatcher(None, map(repr, new), map(repr, old))
+        parts = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                parts.append(("r", i1, i2))
+            elif j2 > j1:
+                parts.append(("v", old[j1:j2]))
+        return ("list", parts)
+
+    else:
+        return ("set", old)
+
+
+# Does not modify the tree but shares unchanged nodes with it
+def inv_apply_delta(tree, delta):
+    if delta[0] == "set":
+        return delta[1]
 
+    elif delta[0] == "dict":
+        tree = dict(tree)
+        for key, subdelta in delta[1].items():
+            if subdelta[0] == "del":
+                del tree[key]
+            else:
+                tree[key] = inv_apply_delta(tree.get(key), subdelta)
+        return tree
+
+    else:
+        new_tree = []
+        for part in delta[1]:
+            if part[0] == "r":
+                new_tree += tree[part[1]:part[2]]
+            else:
+                new_tree += part[1]
+        return new_tree
@@ -89,11 +89,19 @@ def create_nagios_config(outfile = sys.stdout, hostnames = None):
         del extra_service_conf["service_period"]
 
     output_conf_header(outfile)
-    if hostnames == None:
+    all_hosts_selected = hostnames == None
+    if all_hosts_selected:
         hostnames = all_active_hosts()
 
-    for hostname in hostnames:
-        create_nagios_config_host(outfile, hostname)
+    if incremental_core_config:
+        config_fingerprint = nagios_config_fingerprint()
+        for hostname in hostnames:
+            create_nagios_config_host_cached(outfile, hostname, config_fingerprint)
+        if all_hosts_selected:
+            remove_obsolete_nagios_fragments(hostnames)
+    else:
+        for hostname in hostnames:
+            create_nagios_config_host(outfile, hostname)
 
     create_nagios_config_contacts(outfile, hostnames)
     create_nagios_config_hostgroups(outfile)
@@ -117,6 +125,138 @@ def create_nagios_config_host(outfile, hostname):
     create_nagios_servicedefs(outfile, hostname, host_attrs)
 
 
+# Incremental creation of the objects file: The configuration of each
+# host is stored as a fragment in nagios_fragments_dir together with a
+# fingerprint of everything it has been created from. If the fingerprint
+# is unchanged during the next run, the fragment is used as it is. The
+# objects collected during the creation of a host (host groups, commands,
+# ...) and the configuration warnings are stored with the fragment.
+
+nagios_fragments_dir = var_dir + "/core/nagios_fragments"
+
+# Global variables that are filled during the creation of the host objects
+nagios_collected_objects = [
+    "hostgroups_to_define",
+    "servicegroups_to_define",
+    "contactgroups_to_define",
+    "checknames_to_define",
+    "active_checks_to_define",
+    "custom_commands_to_define",
+]
+
+# Configuration variables that are not part of the global fingerprint.
+# They mostly contain per host settings written by WATO. Their effect
+# on a host is part of the fingerprint of that host.
+nagios_host_specific_variables = [
+    "all_hosts",
+    "clusters",
+    "ipaddresses",
+    "ipv6addresses",
+    "explicit_snmp_communities",
+    "host_attributes",
+    "host_paths",
+    "hosttags",
+    "extra_host_conf",
+    "host_contactgroups",
+    "all_hosts_untagged",
+    "all_clusters_untagged",
+]
+
+def nagios_config_fingerprint():
+    fingerprint = hashlib.md5()
+    fingerprint.update(check_mk_version)
+    fingerprint.update(checks_fingerprint())
+
+    for varname in sorted(list(config_variable_names) + derived_config_variable_names):
+        if varname not in nagios_host_specific_variables:
+            fingerprint.update("%s = %r\n" % (varname, globals().get(varname)))
+    fingerprint.update("%r\n" % factory_settings)
+    return fingerprint.hexdigest()
+
+
+def host_config_fingerprint(hostname, config_fingerprint):
+    def host_info(hostname):
+        autochecks_path = autochecksdir + "/" + hostname + ".mk"
+        try:
+            st = os.stat(autochecks_path)
+            autochecks = (st.st_mtime, st.st_size)
+        except OSError:
+            autochecks = None
+        return hostname, tags_of_host(hostname), get_host_attributes(hostname), \
+               host_contactgroups_of([hostname]), host_paths.get(hostname), autochecks
+
+    info = [ config_fingerprint, host_info(hostname) ]
+    if is_cluster(hostname):
+        info += [ host_info(node) for node in nodes_of(hostname) ]
+    else:
+        info += [ (cluster, tags_of_host(cluster)) for cluster in clusters_of(hostname) ]
+    return hashlib.md5(repr(info)).hexdigest()
+
+
+def create_nagios_config_host_cached(outfile, hostname, config_fingerprint):
+    path = nagios_fragments_dir + "/" + hostname
+    fingerprint = host_config_fingerprint(hostname, config_fingerprint)
+
+    try:
+        fragment = read_data_file(path)
+    except Exception:
+        fragment = None
+
+    if not fragment or fragment.get("fingerprint") != fingerprint:
+        fragment = create_nagios_fragment(hostname)
+        if fragment["cacheable"]:
+            fragment["fingerprint"] = fingerprint
+            if not os.path.exists(nagios_fragments_dir):
+                os.makedirs(nagios_fragments_dir)
+            write_data_file(path, fragment)
+        elif os.path.exists(path):
+            os.remove(path)
+    else:
+        for text in fragment["warnings"]:
+            configuration_warning(text)
+
+    outfile.write(fragment["config"])
+    for varname in nagios_collected_objects:
+        globals()[varname].update(fragment[varname])
+
+
+# Creates the configuration of one host and collects the objects that
+# have been registered for it.
+def create_nagios_fragment(hostname):
+    saved_objects = {}
+    for varname in nagios_collected_objects:
+        saved_objects[varname] = globals()[varname]
+        globals()[varname] = set([])
+    num_hostcheck_commands = len(hostcheck_commands_to_define)
+    num_warnings = len(g_configuration_warnings)
+
+    buf = cStringIO.StringIO()
+    try:
+        create_nagios_config_host(buf, hostname)
+    finally:
+        fragment = {}
+        for varname in nagios_collected_objects:
+            fragment[varname] = list(globals()[varname])
+            globals()[varname] = saved_objects[varname]
+
+    fragment["config"] = buf.getvalue()
+    fragment["warnings"] = g_configuration_warnings[num_warnings:]
+    # The names of custom host check commands are numbered in the order of
+    # creation. Such fragments cannot be reused in another run.
+    fragment["cacheable"] = len(hostcheck_commands_to_define) == num_hostcheck_commands
+    return fragment
+
+
+def remove_obsolete_nagios_fragments(hostnames):
+    if not os.path.exists(nagios_fragments_dir):
+        return
+
+    hostnames = set(hostnames)
+    for filename in os.listdir(nagios_fragments_dir):
+        if filename not in hostnames:
+            os.remove(nagios_fragments_dir + "/" + filename)
+
+
 def create_nagios_hostdefs(outfile, hostname, attrs):
     is_clust = is_cluster(hostname)
 
@@ -928,14 +1068,93 @@ def find_check_plugins(checktype):
 def precompile_hostchecks():
     if not os.path.exists(precompiled_hostchecks_dir):
         os.makedirs(precompiled_hostchecks_dir)
-    for host in all_active_hosts():
+
+    hosts = all_active_hosts()
+    num_processes = precompile_num_processes
+    if num_processes < 1:
+        num_processes = os.sysconf("SC_NPROCESSORS_ONLN")
+    num_processes = min(num_processes, len(hosts))
+
+    # The processes inherit the autochecks of all hosts
+    load_autochecks_cache()
+
+    # Shared code objects not used during this run are removed afterwards.
+    # Allow for file systems storing the mtime in seconds.
+    start_time = int(time.time()) - 1
+    g_precompiled_shared_code.clear()
+
+    # Precompile sequentially in verbose and debug mode, so that the
+    # output is readable and exceptions are not hidden in a subprocess
+    if num_processes <= 1 or opt_verbose or opt_debug:
+        success = precompile_hostchecks_of(hosts)
+        save_autochecks_cache()
+        if not success:
+            sys.exit(5)
+        remove_unused_precompiled_shared_code(start_time)
+        return
+
+    # Each process precompiles every num_processes'th host. The entries
+    # it adds to the autochecks cache are passed back through a pipe and
+    # saved by this process.
+    workers = []
+    for nr in range(num_processes):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 5
+            try:
+                try:
+                    os.close(read_fd)
+                    if precompile_hostchecks_of(hosts[nr::num_processes]):
+                        data = serialize_data(new_autochecks_cache_entries())
+                        while data:
+                            data = data[os.write(write_fd, data):]
+                        exit_code = 0
+                except:
+                    pass
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        os.close(write_fd)
+        workers.append((pid, read_fd))
+
+    failed = False
+    for pid, read_fd in workers:
+        chunks = []
+        while True:
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.close(read_fd)
+        if os.waitpid(pid, 0)[1] != 0:
+            failed = True
+        elif chunks:
+            try:
+                add_autochecks_cache_entries(deserialize_data("".join(chunks)))
+            except Exception:
+                pass # the cache is just not updated
+
+    save_autochecks_cache()
+    if failed:
+        sys.exit(5)
+    remove_unused_precompiled_shared_code(start_time)
+
+
+# Returns False if the precompilation of a host has failed
+def precompile_hostchecks_of(hosts):
+    for host in hosts:
         try:
             precompile_hostcheck(host)
         except Exception, e:
             if opt_debug:
                 raise
             sys.stderr.write("Error precompiling checks for host %s: %s\n" % (host, e))
-            sys.exit(5)
+            return False
+    return True
 
 
 # read python file and strip comments
@@ -951,6 +1170,70 @@ def stripped_python_file(filename):
     g_stripped_file_cache[filename] = a
     return a
 
+# The code that is the same for all precompiled host checks (Check_MK
+# modules, checks and global settings) is compiled only once into code
+# objects in precompiled_shared_dir. The precompiled host checks just
+# load these code objects and execute them in their own namespace.
+precompiled_shared_dir = precompiled_hostchecks_dir + "/.shared"
+g_precompiled_shared_code = {}
+
+# Makes sure that the code object name is compiled from source and
+# returns the line that executes it within a precompiled host check.
+# The file name of the code object contains the hash of its source. So
+# an existing file is always up to date and the parallel precompile
+# processes never write different contents to the same file. Each use
+# updates the mtime of the files, which tells the code objects still
+# needed apart from stale ones (see remove_unused_precompiled_shared_code()).
+def precompiled_shared_code(name, source):
+    if name not in g_precompiled_shared_code:
+        source = "# encoding: utf-8\n" + source
+        filename = "%s.%s" % (name, hashlib.md5(source).hexdigest())
+        path = precompiled_shared_dir + "/" + filename
+        source_path = path + ".py"
+        if os.path.exists(path) and os.path.exists(source_path):
+            os.utime(path, None)
+            os.utime(source_path, None)
+        else:
+            if not os.path.exists(precompiled_shared_dir):
+                os.makedirs(precompiled_shared_dir)
+            code = compile(source, source_path, "exec")
+            # The source is kept for tracebacks. Write the code last, so
+            # that it is only used when both files are complete.
+            for p, content in [ (source_path, source), (path, marshal.dumps(code)) ]:
+                tmp_path = p + ".new.%d" % os.getpid()
+                file(tmp_path, "w").write(content)
+                os.rename(tmp_path, p)
+        g_precompiled_shared_code[name] = filename
+    return "load_precompiled_code(%r)\n" % g_precompiled_shared_code[name]
+
+
+# Removes the code objects (and left over temporary files) that have not
+# been used since start_time
+def remove_unused_precompiled_shared_code(start_time):
+    if not os.path.exists(precompiled_shared_dir):
+        return
+    for filename in os.listdir(precompiled_shared_dir):
+        path = precompiled_shared_dir + "/" + filename
+        try:
+            if os.stat(path).st_mtime < start_time:
+                os.remove(path)
+        except OSError:
+            if opt_debug:
+                raise
+
+
+def precompiled_module_code(module):
+    return precompiled_shared_code(module, stripped_python_file(modules_dir + "/" + module + ".py"))
+
+
+def precompiled_check_file_code(filename):
+    if local_checks_dir and filename.startswith(local_checks_dir + "/"):
+        name = "local_check_" + os.path.basename(filename)
+    else:
+        name = "check_" + os.path.basename(filename)
+    return precompiled_shared_code(name, stripped_python_file(filename))
+
+
 # TODO: move this into a new module nagios.py (for creating Nagios config)
 def precompile_hostcheck(hostname):
     if opt_verbose:
@@ -958,20 +1241,20 @@ def precompile_hostcheck(hostname):
 
     compiled_filename = precompiled_hostchecks_dir + "/" + hostname
     source_filename = compiled_filename + ".py"
-    for fname in [ compiled_filename, source_filename ]:
-        try:
-            os.remove(fname)
-        except:
-            pass
 
     # check table, enriched with addition precompiled information.
     check_table = get_precompiled_check_table(hostname)
     if len(check_table) == 0:
+        for fname in [ compiled_filename, source_filename ]:
+            try:
+                os.remove(fname)
+            except:
+                pass
         if opt_verbose:
             sys.stderr.write("(no Check_MK checks)\n")
         return
 
-    output = file(source_filename + ".new", "w")
+    output = cStringIO.StringIO()
     output.write("#!/usr/bin/python\n")
     output.write("# encoding: utf-8\n")
 
@@ -988,11 +1271,18 @@ if os.path.islink(%(dst)r):
 
 """ % { "src" : source_filename, "dst" : compiled_filename })
 
-    output.write(stripped_python_file(modules_dir + "/check_mk_base.py"))
+    output.write("""
+import marshal
+def load_precompiled_code(name):
+    exec marshal.load(file(%r + "/" + name)) in globals()
+
+""" % precompiled_shared_dir)
+
+    output.write(precompiled_module_code("check_mk_base"))
 
     # TODO: can we avoid adding this module if no predictive monitoring
     # is being used?
-    output.write(stripped_python_file(modules_dir + "/prediction.py"))
+    output.write(precompiled_module_code("prediction"))
 
     # initialize global variables
     output.write("""
@@ -1005,7 +1295,7 @@ no_discovery_possible = None
 """)
 
     # Compile in all neccessary global variables
-    output.write("\n# Global variables\n")
+    global_variables = "\n# Global variables\n"
     for var in [ 'check_mk_version', 'tcp_connect_timeout', 'agent_min_version',
                  'perfdata_format', 'aggregation_output_format',
                  'aggr_summary_hostname', 'nagios_command_pipe_path',
@@ -1018,7 +1308,8 @@ no_discovery_possible = None
                  'check_mk_perfdata_with_times', 'livestatus_unix_socket',
                  'use_inline_snmp', 'record_inline_snmp_stats',
                  ]:
-        output.write("%s = %r\n" % (var, globals()[var]))
+        global_variables += "%s = %r\n" % (var, globals()[var])
+    output.write(precompiled_shared_code("global_variables", global_variables))
 
     output.write("\n# Checks for %s\n\n" % hostname)
     output.write("def get_precompiled_check_table(hostname, remove_duplicates=False, world='config'):\n    return %r\n\n" % check_table)
@@ -1057,10 +1348,10 @@ no_discovery_possible = None
     output.write("def check_period_of(hostname, service):\n    return precompiled_service_timeperiods.get(service)\n\n")
 
     if need_snmp_module:
-        output.write(stripped_python_file(modules_dir + "/snmp.py"))
+        output.write(precompiled_module_code("snmp"))
 
         if has_inline_snmp and use_inline_snmp:
-            output.write(stripped_python_file(modules_dir + "/inline_snmp.py"))
+            output.write(precompiled_module_code("inline_snmp"))
             output.write("\ndef oid_range_limits_of(hostname):\n    return %r\n" % oid_range_limits_of(hostname))
         else:
             output.write("has_inline_snmp = False\n")
@@ -1068,7 +1359,7 @@ no_discovery_possible = None
         output.write("has_inline_snmp = False\n")
 
     if agent_simulator:
-        output.write(stripped_python_file(modules_dir + "/agent_simulator.py"))
+        output.write(precompiled_module_code("agent_simulator"))
 
     # check info table
     # We need to include all those plugins that are referenced in the host's
@@ -1108,8 +1399,7 @@ no_discovery_possible = None
 
     for filename in filenames:
         output.write("# %s\n" % filename)
-        output.write(stripped_python_file(filename))
-        output.write("\n\n")
+        output.write(precompiled_check_file_code(filename))
         if opt_verbose:
             sys.stderr.write(" %s%s%s" % (tty_green, filename.split('/')[-1], tty_normal))
 
@@ -1131,6 +1421,7 @@ no_discovery_possible = None
     output.write("def is_snmpv3_host(hostname):\n   return  % r\n\n" % is_snmpv3_host(hostname))
     output.write("def is_tcp_host(hostname):\n   return     % r\n\n" % is_tcp_host(hostname))
     output.write("def is_usewalk_host(hostname):\n   return % r\n\n" % is_usewalk_host(hostname))
+    output.write("def is_snmp_table_walk_host(hostname):\n   return % r\n\n" % is_snmp_table_walk_host(hostname))
     output.write("def snmpv3_contexts_of_host(hostname):\n    return % r\n\n" % snmpv3_contexts_of_host(hostname))
     if has_inline_snmp and use_inline_snmp:
         output.write("def is_snmpv2c_host(hostname):\n   return     % r\n\n" % is_snmpv2c_host(hostname))
@@ -1207,8 +1498,10 @@ no_discovery_possible = None
     # to set the actual values of those variables here. Otherwise the users'
     # settings would get lost. But we only need to set those variables that
     # influence the check itself - not those needed during inventory.
+    check_config_values = ""
     for var in check_config_variables:
-        output.write("%s = %r\n" % (var, eval(var)))
+        check_config_values += "%s = %r\n" % (var, eval(var))
+    output.write(precompiled_shared_code("check_config_variables", check_config_values))
 
     # The same for those checks that use the new API
     for check_type in needed_check_types:
@@ -1250,24 +1543,25 @@ no_discovery_possible = None
     output.write("    l.close()\n")
 
     output.write("    sys.exit(3)\n")
-    output.close()
+    source = output.getvalue()
 
     # compile python (either now or delayed), but only if the source
     # code has not changed. The Python compilation is the most costly
     # operation here.
-    if os.path.exists(source_filename):
-        if file(source_filename).read() == file(source_filename + ".new").read():
+    if os.path.exists(source_filename) and os.path.lexists(compiled_filename):
+        if hashlib.md5(file(source_filename).read()).digest() == hashlib.md5(source).digest():
             if opt_verbose:
                 sys.stderr.write(" (%s is unchanged)\n" % source_filename)
-            os.remove(source_filename + ".new")
             return
         elif opt_verbose:
             sys.stderr.write(" (new content)")
 
+    file(source_filename + ".new", "w").write(source)
     os.rename(source_filename + ".new", source_filename)
     if not delay_precompile:
-        py_compile.compile(source_filename, compiled_filename, compiled_filename, True)
-        os.chmod(compiled_filename, 0755)
+        py_compile.compile(source_filename, compiled_filename + ".new", compiled_filename, True)
+        os.chmod(compiled_filename + ".new", 0755)
+        os.rename(compiled_filename + ".new", compiled_filename)
     else:
         if os.path.exists(compiled_filename) or os.path.islink(compiled_filename):
             os.remove(compiled_filename)
@@ -62,7 +62,12 @@ enable_rulebased_notifications = False
 notification_fallback_email    = ""
 notification_rules             = []
 notification_bulk_interval     = 10 # Check every 10 seconds for ripe bulks
+notification_bulk_spoolfile    = False # Append bulked notifications to one file per bulk
 notification_plugin_timeout    = 60
+notification_plugin_max_concurrent = 10 # Max. number of notification plugins running in parallel
+notification_plugin_concurrency    = {} # Max. per plugin, e.g. { "sms" : 1 }. None is plain email
+notification_plugin_retries        = 2  # Retries on temporary errors (only in keepalive mode)
+notification_plugin_retry_interval = 10 # Delay of first retry, doubled for each further retry
 
 # Notification Spooling.
 
@@ -252,7 +257,12 @@ def notify_notify(raw_context, analyse=False):
         create_spoolfile({"context": raw_context, "forward": True})
 
     if notification_spooling != "remote":
-        return locally_deliver_raw_context(raw_context, analyse=analyse)
+        result = locally_deliver_raw_context(raw_context, analyse=analyse)
+        # In keepalive mode the queued notifications are processed in
+        # the keepalive loop, otherwise we need to wait for them now.
+        if not opt_keepalive:
+            wait_for_notifications()
+        return result
 
 
 # Here we decide which notification implementation we are using.
@@ -340,13 +350,46 @@ def notification_analyse_backlog(nr):
 
 def notify_keepalive():
     event_keepalive(
-        event_function  = notify_notify,
-        log_function    = notify_log,
-        call_every_loop = send_ripe_bulks,
-        loop_interval   = notification_bulk_interval,
+        event_function    = notify_notify,
+        log_function      = notify_log,
+        call_every_loop   = notify_keepalive_loop,
+        loop_interval     = notify_keepalive_loop_interval,
+        shutdown_function = notify_keepalive_shutdown,
     )
 
 
+g_last_bulk_check = 0
+
+def notify_keepalive_loop():
+    global g_last_bulk_check
+    run_notification_queue()
+
+    # New bulked notifications can make a bulk ripe. Otherwise we only
+    # need to look for ripe bulks every notification_bulk_interval.
+    if g_bulk_spooled or time.time() - g_last_bulk_check >= notification_bulk_interval:
+        g_last_bulk_check = time.time()
+        send_ripe_bulks()
+
+    log_delivery_statistics()
+
+
+# Wake up more often while notification plugins are running or queued
+def notify_keepalive_loop_interval():
+    interval = max(0, g_last_bulk_check + notification_bulk_interval - time.time())
+    if g_delivery_running:
+        interval = min(interval, 0.5)
+    for job in g_delivery_queue:
+        interval = min(interval, max(0.5, job["not_before"] - time.time()))
+    return interval
+
+
+def notify_keepalive_shutdown():
+    if g_delivery_queue or g_delivery_running:
+        notify_log("Waiting for %d queued notifications before shutting down" %
+                   (len(g_delivery_queue) + len(g_delivery_running)))
+        wait_for_notifications(final=True)
+
+
 #.
 #   .--Rule-Based-Notifications--------------------------------------------.
 #   |            ____        _      _                        _             |
@@ -374,13 +417,13 @@ def notify_rulebased(raw_context, analyse=False):
     num_rule_matches = 0
     rule_info = []
 
-    for rule in notification_rules + user_notification_rules():
+    for rule, matchers in compiled_notification_rules():
         if "contact" in rule:
             notify_log("User %s's rule '%s'..." % (rule["contact"], rule["description"]))
         else:
             notify_log("Global rule '%s'..." % rule["description"])
 
-        why_not = rbn_match_rule(rule, raw_context) # also checks disabling
+        why_not = rbn_match_rule(rule, raw_context, matchers) # also checks disabling
         if why_not:
             notify_log(" -> does not match: %s" % why_not)
             rule_info.append(("miss", rule, why_not))
@@ -461,7 +504,7 @@ def notify_rulebased(raw_context, analyse=False):
                     elif notification_spooling in ("local", "both"):
                         create_spoolfile({"context": plugin_context, "plugin": plugin})
                     else:
-                        call_notification_script(plugin, plugin_context)
+                        queue_notification(plugin, plugin_context)
 
             except Exception, e:
                 if opt_debug:
@@ -496,6 +539,26 @@ def add_rulebased_macros(raw_context):
     raw_context["CONTACTNAME"] = "check-mk-notify"
 
 
+# The notification rules are compiled when they are needed for the first
+# time. The same holds for the members of the contact groups and the
+# contacts of the objects, which are fetched via Livestatus. All of them
+# only change with the configuration. The keepalive mode restarts itself
+# when the configuration has changed, so they are valid for the whole
+# lifetime of the process.
+g_compiled_notification_rules = None
+g_contactgroup_members        = None
+g_object_contacts             = {}
+
+# Returns the list of pairs of rule and its compiled matchers
+def compiled_notification_rules():
+    global g_compiled_notification_rules
+    if g_compiled_notification_rules == None:
+        g_compiled_notification_rules = [
+            (rule, rbn_rule_matchers(rule))
+            for rule in notification_rules + user_notification_rules() ]
+    return g_compiled_notification_rules
+
+
 # Create a table of all user specific notification rules. Important:
 # create deterministic order, so that rule analyses can depend on
 # rule indices
@@ -549,6 +612,10 @@ def rbn_add_contact_information(plugin_context, contact):
 
 
 def livestatus_fetch_contacts(host, service):
+    key = host, service
+    if key in g_object_contacts:
+        return g_object_contacts[key]
+
     try:
         if service:
             query = "GET services\nFilter: host_name = %s\nFilter: service_description = %s\nColumns: contacts\n" % (
@@ -560,7 +627,8 @@ def livestatus_fetch_contacts(host, service):
         aslist = commasepped.split(",")
         if "check-mk-notify" in aslist: # Remove artifical contact used for rule based notifications
             aslist.remove("check-mk-notify")
-        return ",".join(aslist)
+        g_object_contacts[key] = ",".join(aslist)
+        return g_object_contacts[key]
 
     except:
         if opt_debug:
@@ -569,17 +637,19 @@ def livestatus_fetch_contacts(host, service):
 
 
 
-def rbn_match_rule(rule, context):
+def rbn_match_rule(rule, context, matchers=None):
+    if matchers == None:
+        matchers = rbn_rule_matchers(rule)
+    return event_match_compiled_rule(matchers, rule, context)
+
+
+# Compile a rule into the list of the match functions needed for it
+def rbn_rule_matchers(rule):
     if rule.get("disabled"):
-        return "This rule is disabled"
+        return [ lambda rule, context: "This rule is disabled" ]
 
-    return event_match_rule(rule, context)             or \
-        rbn_match_escalation(rule, context)            or \
-        rbn_match_escalation_throtte(rule, context)    or \
-        rbn_match_host_event(rule, context)            or \
-        rbn_match_service_event(rule, context)         or \
-        rbn_match_notification_comment(rule, context)  or \
-        rbn_match_event_console(rule, context)
+    return event_rule_matchers(rule) + \
+           [ matcher for key, matcher in rbn_rule_conditions if key in rule ]
 
 
 def rbn_match_escalation(rule, context):
@@ -748,6 +818,17 @@ def rbn_match_event_console(rule, context):
                         context["EC_COMMENT"], match_ec["match_comment"])
 
 
+# Conditions of notification rules in addition to event_rule_conditions
+rbn_rule_conditions = [
+    ( "match_escalation",           rbn_match_escalation ),
+    ( "match_escalation_throttle",  rbn_match_escalation_throtte ),
+    ( "match_host_event",           rbn_match_host_event ),
+    ( "match_service_event",        rbn_match_service_event ),
+    ( "match_notification_comment", rbn_match_notification_comment ),
+    ( "match_ec",                   rbn_match_event_console ),
+]
+
+
 def rbn_object_contacts(context):
     commasepped = context.get("CONTACTS")
     if commasepped:
@@ -770,19 +851,28 @@ def rbn_all_contacts(with_email=None):
 def rbn_groups_contacts(groups):
     if not groups:
         return {}
+    members = contactgroup_members_of_core()
     contacts = set([])
-    query = "GET contactgroups\nColumns: members\n"
     for group in groups:
-        query += "Filter: name = %s\n" % group
-    query += "Or: %d\n" % len(groups)
-    response = livestatus_fetch_query(query)
-    for line in response.splitlines():
-        line = line.strip()
-        if line:
-            contacts.update(line.split(","))
+        contacts.update(members.get(group, []))
     return contacts
 
 
+# Fetches the members of all contact groups from the core once
+def contactgroup_members_of_core():
+    global g_contactgroup_members
+    if g_contactgroup_members == None:
+        members = {}
+        response = livestatus_fetch_query("GET contactgroups\nColumns: name members\n")
+        for line in response.splitlines():
+            line = line.strip()
+            if line:
+                name, group_members = line.split(";", 1)
+                members[name] = [ m for m in group_members.split(",") if m ]
+        g_contactgroup_members = members
+    return g_contactgroup_members
+
+
 def rbn_emails_contacts(emails):
     return [ "mailto:" + e for e in emails ]
 
@@ -1138,7 +1228,7 @@ def call_notification_script(plugin, plugin_context):
         for line in p.stdout:
             plugin_log("Output: %s" % line.rstrip().decode('utf-8'))
 
-        exitcode = p.returncode
+        exitcode = p.wait()
         clear_notification_timeout()
     except NotificationTimeout:
         plugin_log("Notification plugin did not finish within %d seconds. Terminating." %
@@ -1176,6 +1266,160 @@ def set_notification_timeout():
 def clear_notification_timeout():
     signal.alarm(0)
 
+#.
+#   .--Delivery------------------------------------------------------------.
+#   |                ____       _ _                                        |
+#   |               |  _ \  ___| (_)_   _____ _ __ _   _                   |
+#   |               | | | |/ _ \ | \ \ / / _ \ '__| | | |                  |
+#   |               | |_| |  __/ | |\ V /  __/ |  | |_| |                  |
+#   |               |____/ \___|_|_| \_/ \___|_|   \__, |                  |
+#   |                                              |___/                   |
+#   +----------------------------------------------------------------------+
+#   |  Rule based notifications do not call the notification plugins one   |
+#   |  after another. Each invocation is queued and executed in a forked   |
+#   |  process, so that a slow plugin does not delay the other ones. The   |
+#   |  number of concurrent invocations is limited globally and per        |
+#   |  plugin. In keepalive mode invocations failing with exit code 1      |
+#   |  (temporary error) are retried with an increasing delay. Otherwise   |
+#   |  we wait for all invocations before exiting.                         |
+#   '----------------------------------------------------------------------'
+
+g_delivery_queue        = [] # Jobs waiting for being executed
+g_delivery_running      = {} # pid -> job
+g_delivery_stats        = {} # plugin -> [ num delivered, num failed, sum latency, max latency ]
+g_delivery_stats_logged = time.time()
+delivery_stats_interval = 300 # Log delivery statistics every 5 minutes in keepalive mode
+
+def queue_notification(plugin, plugin_context):
+    g_delivery_queue.append({
+        "plugin"    : plugin,
+        "context"   : plugin_context,
+        "queued"    : time.time(),
+        "attempt"   : 1,
+        "not_before": 0,
+    })
+    run_notification_queue()
+
+
+def plugin_title(plugin):
+    return plugin or "plain email"
+
+
+# Reap finished invocations and start queued ones as far as the limits
+# allow. Queued jobs of plugins that are at their limit are skipped, so
+# they do not block the jobs of other plugins. If final is set then jobs
+# waiting for a retry are started right now and will not be retried again.
+def run_notification_queue(final=False):
+    reap_notification_processes(final)
+
+    now = time.time()
+    running_per_plugin = {}
+    for job in g_delivery_running.values():
+        running_per_plugin[job["plugin"]] = running_per_plugin.get(job["plugin"], 0) + 1
+
+    for job in g_delivery_queue[:]:
+        if len(g_delivery_running) >= max(1, notification_plugin_max_concurrent):
+            break
+
+        if job["not_before"] > now and not final:
+            continue
+
+        plugin = job["plugin"]
+        plugin_limit = notification_plugin_concurrency.get(plugin)
+        if plugin_limit and running_per_plugin.get(plugin, 0) >= plugin_limit:
+            continue
+
+        g_delivery_queue.remove(job)
+        if opt_debug:
+            # Run within our own process in order to see exceptions
+            finish_notification_job(job, call_notification_script(plugin, job["context"]), final)
+            continue
+
+        pid = os.fork()
+        if pid == 0:
+            # Never return into the caller, not even on SystemExit
+            exitcode = 2
+            try:
+                try:
+                    exitcode = call_notification_script(plugin, job["context"]) or 0
+                except Exception, e:
+                    notify_log("ERROR: %s\n%s" % (e, format_exception()))
+            finally:
+                os._exit(exitcode)
+
+        g_delivery_running[pid] = job
+        running_per_plugin[plugin] = running_per_plugin.get(plugin, 0) + 1
+
+
+def reap_notification_processes(final=False):
+    for pid, job in g_delivery_running.items():
+        try:
+            result_pid, status = os.waitpid(pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            result_pid, status = pid, 2 << 8 # Should never happen
+
+        if result_pid:
+            del g_delivery_running[pid]
+            if os.WIFEXITED(status):
+                exitcode = os.WEXITSTATUS(status)
+            else:
+                exitcode = 2 # killed by signal
+            finish_notification_job(job, exitcode, final)
+
+
+def finish_notification_job(job, exitcode, final):
+    plugin = job["plugin"]
+    context = job["context"]
+    if exitcode == 1 and opt_keepalive and not final \
+       and job["attempt"] <= notification_plugin_retries:
+        delay = notification_plugin_retry_interval * 2 ** (job["attempt"] - 1)
+        notify_log("Notification via %s for %s failed temporarily. Retrying in %d seconds." %
+                   (plugin_title(plugin), find_host_service_in_context(context), delay))
+        job["attempt"] += 1
+        job["not_before"] = time.time() + delay
+        g_delivery_queue.append(job)
+        return
+
+    latency = time.time() - job["queued"]
+    stats = g_delivery_stats.setdefault(plugin, [ 0, 0, 0.0, 0.0 ])
+    if exitcode:
+        stats[1] += 1
+        notify_log("Notification via %s for %s failed with exit code %d after %.2f sec (%d attempts)" %
+                   (plugin_title(plugin), find_host_service_in_context(context),
+                    exitcode, latency, job["attempt"]))
+    else:
+        stats[0] += 1
+        notify_log("Notification via %s for %s delivered after %.2f sec" %
+                   (plugin_title(plugin), find_host_service_in_context(context), latency))
+    stats[2] += latency
+    stats[3] = max(stats[3], latency)
+
+
+def wait_for_notifications(final=False):
+    while g_delivery_queue or g_delivery_running:
+        run_notification_queue(final)
+        if g_delivery_queue or g_delivery_running:
+            time.sleep(0.05)
+
+
+def log_delivery_statistics():
+    global g_delivery_stats, g_delivery_stats_logged
+    now = time.time()
+    if now - g_delivery_stats_logged < delivery_stats_interval:
+        return
+
+    for plugin, (delivered, failed, latency_sum, latency_max) in sorted(g_delivery_stats.items()):
+        notify_log("Delivery statistics for %s: %d delivered, %d failed, "
+                   "latency avg %.2f sec, max %.2f sec" % (plugin_title(plugin),
+                   delivered, failed, latency_sum / (delivered + failed), latency_max))
+    if g_delivery_queue or g_delivery_running:
+        notify_log("Notification queue: %d running, %d waiting" %
+                   (len(g_delivery_running), len(g_delivery_queue)))
+    g_delivery_stats = {}
+    g_delivery_stats_logged = now
+
 #.
 #   .--Spooling------------------------------------------------------------.
 #   |               ____                    _ _                            |
@@ -1224,6 +1468,7 @@ def handle_spoolfile(spoolfile):
 
             store_notification_backlog(data["context"])
             locally_deliver_raw_context(data["context"])
+            wait_for_notifications(final=True)
             return 0 # No error handling for async delivery
 
     except Exception, e:
@@ -1283,11 +1528,27 @@ def do_bulk_notify(contact, plugin, params, plugin_context, bulk):
         bulk_path += (macroname.lower(), value)
 
     notify_log("    --> storing for bulk notification %s" % "|".join(bulk_path))
-    bulk_dirname = create_bulk_dirname(bulk_path)
-    uuid = fresh_uuid()
-    filename = bulk_dirname + "/" + uuid
-    file(filename + ".new", "w").write("%r\n" % ((params, plugin_context),))
-    os.rename(filename + ".new", filename) # We need an atomic creation!
+    lock_fd = lock_bulks()
+    try:
+        bulk_dirname = create_bulk_dirname(bulk_path)
+        uuid = fresh_uuid()
+        if notification_bulk_spoolfile:
+            # Append to the spool file of this bulk. All writers hold the bulk
+            # lock, so lines cannot be interleaved.
+            filename = bulk_dirname + "/" + bulk_spoolfile_name
+            mtime = round(time.time(), 3)
+            file(filename, "a").write("%.3f %s %r\n" % (mtime, uuid, (params, plugin_context)))
+        else:
+            filename = bulk_dirname + "/" + uuid
+            file(filename + ".new", "w").write("%r\n" % ((params, plugin_context),))
+            os.rename(filename + ".new", filename) # We need an atomic creation!
+            mtime = os.stat(filename).st_mtime
+        append_bulk_journal([("+", relative_bulk_dirname(bulk_dirname), mtime)])
+    finally:
+        unlock_bulks(lock_fd)
+
+    global g_bulk_spooled
+    g_bulk_spooled = True
     notify_log("        - stored in %s" % filename)
 
 
@@ -1320,13 +1581,130 @@ def create_bulk_dirname(bulk_path):
     return dirname
 
 
-def find_bulks(only_ripe):
+# All bulks are tracked in an index that maps the bulk directory (relative
+# to notification_bulkdir) to the time of its oldest notification and the
+# number of notifications. That way finding the ripe bulks does not need
+# to look into each spooled notification. The index is persisted as a
+# journal: every process that spools or sends notifications appends its
+# changes to it while holding the bulk lock. In keepalive mode the index
+# is kept in memory and only the new part of the journal is being read.
+# If the journal is missing or broken, the index is rebuilt from the bulk
+# directories.
+bulk_spoolfile_name      = ".spool"
+bulk_journal_version     = 1
+bulk_journal_min_records = 1000 # never compact journal with less records
+g_bulk_index             = None # relative bulk dirname -> [ oldest, count ]
+g_bulk_journal           = None # (inode, offset, number of records) already read
+g_bulk_spooled           = False # new notifications spooled since last send_ripe_bulks()
+
+
+def lock_bulks():
     if not os.path.exists(notification_bulkdir):
-        return []
+        os.makedirs(notification_bulkdir)
+    lock_fd = os.open(notification_bulkdir + "/.lock", os.O_RDWR | os.O_CREAT, 0660)
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    return lock_fd
 
-    now = time.time()
-    bulks = []
 
+def unlock_bulks(lock_fd):
+    os.close(lock_fd) # also releases the lock
+
+
+def relative_bulk_dirname(dirname):
+    return dirname[len(notification_bulkdir) + 1:]
+
+
+def bulk_journal_path():
+    return notification_bulkdir + "/.journal"
+
+
+# Must be called while holding the bulk lock
+def append_bulk_journal(records):
+    f = file(bulk_journal_path(), "a")
+    f.write("".join([ "%r\n" % (record,) for record in records ]))
+    f.close()
+
+
+def apply_bulk_journal(index, records):
+    for record in records:
+        if record[0] == "+":
+            entry = index.get(record[1])
+            if entry:
+                entry[0] = min(entry[0], record[2])
+                entry[1] += 1
+            else:
+                index[record[1]] = [ record[2], 1 ]
+        elif record[0] == "=":
+            if record[3]:
+                index[record[1]] = [ record[2], record[3] ]
+            elif record[1] in index:
+                del index[record[1]]
+
+
+# Bring the bulk index up to date with the journal. Must be called
+# while holding the bulk lock.
+def load_bulk_index():
+    global g_bulk_index, g_bulk_journal
+    try:
+        f = file(bulk_journal_path())
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        notify_log("Bulk journal is missing, rebuilding bulk index")
+        return rebuild_bulk_index()
+
+    inode = os.fstat(f.fileno()).st_ino
+    if g_bulk_index != None and g_bulk_journal and g_bulk_journal[0] == inode:
+        index = g_bulk_index
+        offset, num_records = g_bulk_journal[1:]
+        f.seek(offset)
+    else:
+        index = None
+        offset, num_records = 0, 0
+
+    data = f.read()
+    f.close()
+    end = data.rfind("\n") + 1 # ignore incomplete lines
+    try:
+        records = map(eval, data[:end].splitlines())
+        if index == None:
+            # A journal without header has been created by a spooling process
+            # after the journal had been removed. The index is incomplete then.
+            if not records or records[0] != ("#", bulk_journal_version):
+                notify_log("Bulk journal is incomplete, rebuilding bulk index")
+                return rebuild_bulk_index()
+            index = {}
+            records = records[1:]
+        apply_bulk_journal(index, records)
+    except Exception, e:
+        if opt_debug:
+            raise
+        notify_log("Invalid bulk journal (%s), rebuilding bulk index" % e)
+        return rebuild_bulk_index()
+
+    g_bulk_index = index
+    num_records += len(records)
+    g_bulk_journal = (inode, offset + end, num_records)
+    if num_records > max(bulk_journal_min_records, 4 * len(index)):
+        save_bulk_index(index)
+    return index
+
+
+# Write the complete index as a new journal
+def save_bulk_index(index):
+    global g_bulk_index, g_bulk_journal
+    records = [ ("#", bulk_journal_version) ] + \
+              [ ("=", dirname, oldest, count) for dirname, (oldest, count) in index.items() ]
+    data = "".join([ "%r\n" % (record,) for record in records ])
+    path = bulk_journal_path()
+    file(path + ".new", "w").write(data)
+    os.rename(path + ".new", path)
+    g_bulk_index = index
+    g_bulk_journal = (os.stat(path).st_ino, len(data), len(records))
+
+
+def rebuild_bulk_index():
+    index = {}
     dir_1 = notification_bulkdir
     for contact in os.listdir(dir_1):
         if contact.startswith("."):
@@ -1337,53 +1715,158 @@ def find_bulks(only_ripe):
                 continue
             dir_3 = dir_2 + "/" + method
             for bulk in os.listdir(dir_3):
-                parts = bulk.split(',') # e.g. 60,10,host,localhost
-                try:
-                    interval = int(parts[0])
-                    count = int(parts[1])
-                except:
-                    notify_log("Skipping invalid bulk directory %s" % dir_3)
-                    continue
                 dir_4 = dir_3 + "/" + bulk
-                uuids = []
-                oldest = time.time()
-                for uuid in os.listdir(dir_4): # 4ded0fa2-f0cd-4b6a-9812-54374a04069f
-                    if uuid.startswith(".") or uuid.endswith(".new"):
-                        continue
-                    if len(uuid) != 36:
-                        notify_log("Skipping invalid notification file %s/%s" % (dir_4, uuid))
-                        continue
-
-                    mtime = os.stat(dir_4 + "/" + uuid).st_mtime
-                    uuids.append((mtime, uuid))
-                    oldest = min(oldest, mtime)
-
-                uuids.sort()
-                if not uuids:
-                    dirage = now - os.stat(dir_4).st_mtime
-                    if dirage > 60:
-                        notify_log("Warning: removing orphaned empty bulk directory %s" % dir_4)
-                        try:
-                            os.rmdir(dir_4)
-                        except Exception, e:
-                            notify_log("    -> Error removing it: %s" % e)
-                    continue
+                uuids = list_bulk_entries(dir_4)
+                if uuids:
+                    index[relative_bulk_dirname(dir_4)] = [ uuids[0][0], len(uuids) ]
+                else:
+                    remove_empty_bulk_dir(dir_4)
+    save_bulk_index(index)
+    return index
+
 
+def remove_empty_bulk_dir(dirname):
+    notify_log("Warning: removing orphaned empty bulk directory %s" % dirname)
+    try:
+        os.rmdir(dirname)
+    except Exception, e:
+        notify_log("    -> Error removing it: %s" % e)
+
+
+# Returns the sorted list of (mtime, uuid) of all notifications spooled
+# in a bulk, either as single files or in the spool file of the bulk.
+def list_bulk_entries(dirname):
+    uuids = []
+    try:
+        filenames = os.listdir(dirname)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return uuids
+
+    for uuid in filenames: # 4ded0fa2-f0cd-4b6a-9812-54374a04069f
+        if uuid.startswith(".") or uuid.endswith(".new"):
+            continue
+        if len(uuid) != 36:
+            notify_log("Skipping invalid notification file %s/%s" % (dirname, uuid))
+            continue
+        mtime = os.stat(dirname + "/" + uuid).st_mtime
+        uuids.append((mtime, uuid))
+
+    for mtime, uuid, spooled in read_bulk_spoolfile(dirname):
+        uuids.append((mtime, uuid))
+
+    uuids.sort()
+    return uuids
+
+
+def read_bulk_spoolfile(dirname):
+    entries = []
+    try:
+        lines = file(dirname + "/" + bulk_spoolfile_name).readlines()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return entries
+
+    for line in lines:
+        try:
+            mtime, uuid, spooled = line.split(" ", 2)
+            entries.append((float(mtime), uuid, spooled))
+        except ValueError:
+            notify_log("Skipping invalid line in %s/%s" % (dirname, bulk_spoolfile_name))
+    return entries
+
+
+# Called after (some of) the notifications of a bulk have been sent.
+# Removes them from the spool file and updates the bulk index.
+def update_sent_bulk(dirname, sent_uuids):
+    lock_fd = lock_bulks()
+    try:
+        spoolfile = dirname + "/" + bulk_spoolfile_name
+        entries = read_bulk_spoolfile(dirname)
+        if entries:
+            lines = [ "%.3f %s %s" % entry for entry in entries if entry[1] not in sent_uuids ]
+            if lines:
+                file(spoolfile + ".new", "w").write("".join(lines))
+                os.rename(spoolfile + ".new", spoolfile)
+            else:
+                os.remove(spoolfile)
+
+        uuids = list_bulk_entries(dirname)
+        if uuids:
+            record = ("=", relative_bulk_dirname(dirname), uuids[0][0], len(uuids))
+        else:
+            record = ("=", relative_bulk_dirname(dirname), 0, 0)
+            try:
+                os.rmdir(dirname)
+            except Exception, e:
+                notify_log("Warning: cannot remove directory %s: %s" % (dirname, e))
+        append_bulk_journal([record])
+    finally:
+        unlock_bulks(lock_fd)
+
+
+def find_bulks(only_ripe):
+    if not os.path.exists(notification_bulkdir):
+        return []
+
+    now = time.time()
+    bulks = []
+
+    lock_fd = lock_bulks()
+    try:
+        index = load_bulk_index()
+        corrections = []
+        for relative_dirname, (oldest, count) in sorted(index.items()):
+            dir_4 = notification_bulkdir + "/" + relative_dirname
+            parts = relative_dirname.split("/")[-1].split(',') # e.g. 60,10,host,localhost
+            try:
+                interval = int(parts[0])
+                maxcount = int(parts[1])
+            except:
+                notify_log("Skipping invalid bulk directory %s" % dir_4)
+                continue
+
+            age = now - oldest
+            if only_ripe and age < interval and count < maxcount:
+                notify_log("Bulk %s is not ripe yet (age: %d, count: %d)!" % (dir_4, age, count))
+                continue
+
+            # The index might be outdated if someone has tampered with
+            # the bulk directory. Correct it from the actual entries.
+            uuids = list_bulk_entries(dir_4)
+            if not uuids:
+                if os.path.exists(dir_4):
+                    remove_empty_bulk_dir(dir_4)
+                corrections.append(("=", relative_dirname, 0, 0))
+                continue
+            elif uuids[0][0] != oldest or len(uuids) != count:
+                oldest, count = uuids[0][0], len(uuids)
+                corrections.append(("=", relative_dirname, oldest, count))
                 age = now - oldest
-                if age >= interval:
-                    notify_log("Bulk %s is ripe: age %d >= %d" % (dir_4, age, interval))
-                elif len(uuids) >= count:
-                    notify_log("Bulk %s is ripe: count %d >= %d" % (dir_4, len(uuids), count))
-                else:
-                    notify_log("Bulk %s is not ripe yet (age: %d, count: %d)!" % (dir_4, age, len(uuids)))
-                    if only_ripe:
-                        continue
 
-                bulks.append((dir_4, age, interval, count, uuids))
+            if age >= interval:
+                notify_log("Bulk %s is ripe: age %d >= %d" % (dir_4, age, interval))
+            elif count >= maxcount:
+                notify_log("Bulk %s is ripe: count %d >= %d" % (dir_4, count, maxcount))
+            else:
+                notify_log("Bulk %s is not ripe yet (age: %d, count: %d)!" % (dir_4, age, count))
+                if only_ripe:
+                    continue
+
+            bulks.append((dir_4, age, interval, maxcount, uuids))
+
+        if corrections:
+            append_bulk_journal(corrections)
+    finally:
+        unlock_bulks(lock_fd)
 
     return bulks
 
 def send_ripe_bulks():
+    global g_bulk_spooled
+    g_bulk_spooled = False
     ripe = find_bulks(True)
     if ripe:
         notify_log("Sending out %d ripe bulk notifications" % len(ripe))
@@ -1408,9 +1891,13 @@ def notify_bulk(dirname, uuids):
     bulk_context = []
     old_params = None
     unhandled_uuids = []
+    spooled = dict([ (entry[1], entry[2]) for entry in read_bulk_spoolfile(dirname) ])
     for mtime, uuid in uuids:
         try:
-            params, context = eval(file(dirname + "/" + uuid).read())
+            if uuid in spooled:
+                params, context = eval(spooled[uuid])
+            else:
+                params, context = eval(file(dirname + "/" + uuid).read())
         except Exception, e:
             if opt_debug:
                 raise
@@ -1453,25 +1940,25 @@ def notify_bulk(dirname, uuids):
         notify_log("No valid notification file left. Skipping this bulk.")
 
     # Remove sent notifications
+    sent_uuids = set([])
     for mtime, uuid in uuids:
         if (mtime, uuid) not in unhandled_uuids:
+            sent_uuids.add(uuid)
+            if uuid in spooled:
+                continue # removed from spool file in update_sent_bulk()
             path = dirname + "/" + uuid
             try:
                 os.remove(path)
             except Exception, e:
                 notify_log("Cannot remove %s: %s" % (path, e))
 
+    # Update the bulk index. This also removes the directory if empty
+    update_sent_bulk(dirname, sent_uuids)
+
     # Repeat with unhandled uuids (due to different parameters)
     if unhandled_uuids:
         notify_bulk(dirname, unhandled_uuids)
 
-    # Remove directory. Not neccessary if emtpy
-    try:
-        os.rmdir(dirname)
-    except Exception, e:
-        if not unhandled_uuids:
-            notify_log("Warning: cannot remove directory %s: %s" % (dirname, e))
-
 
 def call_bulk_notification_script(plugin, context_text):
     path = path_to_notification_script(plugin)
@@ -46,6 +46,42 @@ def rrd_export(filename, ds, cf, fromtime, untiltime, rrdcached=None):
     if exit_code:
         raise MKGeneralException("Cannot fetch RRD data: %s" % output)
 
+    return parse_rrd_export(output)
+
+
+# Export several time ranges from an RRD file with one rrdtool process
+# (running in pipe mode). Returns a list of pairs of step and data.
+def rrd_export_ranges(filename, ds, cf, ranges, rrdcached=None):
+    commands = []
+    for fromtime, untiltime in ranges:
+        cmd = "xport --json -s %d -e %d --step 60 " % (fromtime, untiltime)
+        if rrdcached and os.path.exists(rrdcached):
+            cmd += "--daemon %s " % rrdcached
+        cmd += "DEF:x=%s:%s:%s XPORT:x\n" % (filename, ds, cf)
+        commands.append(cmd)
+
+    p = subprocess.Popen(["rrdtool", "-"], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate("".join(commands))[0]
+
+    # Each answer is terminated by a line "OK u:0.00 s:0.00 r:0.00"
+    results = []
+    answer = []
+    for line in output.splitlines(True):
+        if line.startswith("OK u:"):
+            results.append(parse_rrd_export("".join(answer)))
+            answer = []
+        elif line.startswith("ERROR:"):
+            raise MKGeneralException("Cannot fetch RRD data: %s" % line.strip())
+        else:
+            answer.append(line)
+
+    if len(results) != len(ranges):
+        raise MKGeneralException("Cannot fetch RRD data: %s" % output)
+    return results
+
+
+def parse_rrd_export(output):
     # Parse without json module (this is not always available)
     # Our data begins at "data: [...". The sad thing: names are not
     # quoted here. Don't know why. We fake this by defining variables.
@@ -84,6 +120,11 @@ def find_ds_in_pnp_xmlfile(xml_file, varname):
             name = None
 
 def get_rrd_data(hostname, service_description, varname, cf, fromtime, untiltime):
+    rrd_file, ds = find_rrd_file(hostname, service_description, varname)
+    return rrd_export(rrd_file, ds, cf, fromtime, untiltime, rrdcached_socket)
+
+
+def find_rrd_file(hostname, service_description, varname):
     global rrdcached_socket
     rrd_base = "%s/%s/%s" % (rrd_path, pnp_cleanup(hostname),
              pnp_cleanup(service_description))
@@ -108,7 +149,115 @@ def get_rrd_data(hostname, service_description, varname, cf, fromtime, untiltime
 
     if omd_root and not rrdcached_socket:
         rrdcached_socket = omd_root + "/tmp/run/rrdcached.sock"
-    return rrd_export(rrd_file, ds, cf, fromtime, untiltime, rrdcached_socket)
+    return rrd_file, ds
+
+
+# Get the data of several time ranges (slices). The data of slices that
+# are completely in the past is being cached in the prediction directory,
+# so that a new prediction only needs to fetch the new slices. Since
+# the RRD consolidates older data to coarser steps, a cached slice is
+# only used as long as rrdtool would export it with the same step.
+prediction_slice_cache_delay = 7200 # do not cache slices younger than that
+
+def get_rrd_data_slices(hostname, service_description, varname, cf, ranges, cache_dir):
+    rrd_file, ds = find_rrd_file(hostname, service_description, varname)
+    rrd_id = rrd_file, ds, os.stat(rrd_file).st_ino
+
+    cache_file = cache_dir + "/.slices"
+    try:
+        cache = read_data_file(cache_file)
+        if cache["rrd"] != rrd_id:
+            raise MKGeneralException("RRD file has changed")
+    except Exception:
+        cache = { "rrd" : rrd_id, "archives" : rrd_archives(rrd_file), "slices" : {} }
+    slices = cache["slices"]
+
+    now = time.time()
+    missing = []
+    for r in ranges:
+        key = (cf,) + r
+        if key in slices and slices[key][0] != rrd_export_step(cache["archives"], cf, r[0], now):
+            del slices[key] # resolution of RRD data has changed meanwhile
+        if key not in slices:
+            missing.append(r)
+
+    if missing:
+        if opt_debug:
+            sys.stderr.write("Fetching %d of %d slices from RRD.\n" % (len(missing), len(ranges)))
+        fetched = dict(zip(missing, rrd_export_ranges(rrd_file, ds, cf, missing, rrdcached_socket)))
+    else:
+        fetched = {}
+
+    result = []
+    for r in ranges:
+        if r in fetched:
+            step, data = fetched[r]
+            if r[1] < now - prediction_slice_cache_delay:
+                slices[(cf,) + r] = step, zlib.compress(marshal.dumps(data), 1)
+        else:
+            step, packed = slices[(cf,) + r]
+            data = marshal.loads(zlib.decompress(packed))
+        result.append((step, data))
+
+    # Forget about slices older than the time horizon
+    oldest = min([ r[0] for r in ranges ])
+    for key in slices.keys():
+        if key[1] < oldest:
+            del slices[key]
+
+    write_data_file(cache_file, cache)
+    return result
+
+
+# Returns the base step and the list of archives (cf, pdp_per_row, rows)
+# of an RRD file.
+def rrd_archives(rrd_file):
+    p = subprocess.Popen(["rrdtool", "info", rrd_file],
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+    if p.returncode:
+        raise MKGeneralException("Cannot get info about RRD: %s" % output)
+
+    step = None
+    archives = {}
+    for line in output.splitlines():
+        if " = " not in line:
+            continue
+        key, value = line.split(" = ", 1)
+        if key == "step":
+            step = int(value)
+        elif key.startswith("rra["):
+            nr, attr = key[4:].split("].", 1)
+            if attr in [ "cf", "pdp_per_row", "rows" ]:
+                archives.setdefault(int(nr), {})[attr] = value.strip('"')
+
+    return step, [ (a["cf"], int(a["pdp_per_row"]), int(a["rows"]))
+                   for nr, a in sorted(archives.items()) ]
+
+
+# Determines the step of the data rrdtool would export for a slice
+# beginning at fromtime - like rrd_fetch() selects the archive: the one
+# with a step next to the wanted one (60) that contains fromtime, or
+# the one reaching back the most.
+def rrd_export_step(archives, cf, fromtime, now):
+    base_step, rras = archives
+    best_full = None
+    best_part = None
+    for rra_cf, pdp_per_row, rows in rras:
+        if rra_cf != cf:
+            continue
+        step = base_step * pdp_per_row
+        begin = now - now % step - step * rows
+        if begin <= fromtime:
+            if best_full == None or abs(60 - step) < abs(60 - best_full):
+                best_full = step
+        elif best_part == None or begin < best_part[0]:
+            best_part = begin, step
+
+    if best_full:
+        return best_full
+    elif best_part:
+        return best_part[1]
 
 daynames = [ "monday", "tuesday", "wednesday", "thursday",
              "friday", "saturday", "sunday"]
@@ -178,7 +327,6 @@ def compute_prediction(pred_file, timegroup, params, period_info, from_time, dsn
     # Collect all slices back into the past until the time horizon
     # is reached
     begin = from_time
-    slices = []
     absolute_begin = from_time - params["horizon"] * 86400
 
     # The resolutions of the different time ranges differ. We interpolate
@@ -190,34 +338,32 @@ def compute_prediction(pred_file, timegroup, params, period_info, from_time, dsn
     # DST and non-DST during are computation. We need to compensate for
     # those. DST swaps within slices are being ignored. The DST flag
     # is checked against the beginning of the slice.
-    smallest_step = None
+    ranges = []
     while begin >= absolute_begin:
         tg, fr, un, rel = get_prediction_timegroup(begin, period_info)
         if tg == timegroup:
-            step, data = get_rrd_data(g_hostname, g_service_description,
-                                      dsname, cf, fr, un-1)
-            if smallest_step == None:
-                smallest_step = step
-            slices.append((fr, step / smallest_step, data))
+            ranges.append((fr, un-1))
         begin -= period_info["slice"]
 
+    slices = get_rrd_data_slices(g_hostname, g_service_description, dsname, cf,
+                                 ranges, os.path.dirname(pred_file))
+
     # Now we have all the RRD data we need. The next step is to consolidate
-    # all that data into one new array.
-    num_points = len(slices[0][2])
-    consolidated = []
-    for i in xrange(num_points):
-        # print "PUNKT %d --------------------------------------" % i
-        point_line = []
-        for from_time, scale, data in slices:
-            idx = int(i / float(scale))
-            if idx < len(data):
-                d = data[idx]
-                if d != None:
-                    point_line.append(d)
-            # else:
-            #     date_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(fr + ((un - fr) * i / float(num_points))))
-            #     print "Keine Daten fur %s / %d/%s/ %.2f " % (date_str, i, float(scale),i/float(scale))
+    # all that data into one new array. All slices are scaled to the
+    # smallest step (the one of the youngest slice) and then consolidated
+    # point by point.
+    smallest_step = slices[0][0]
+    num_points = len(slices[0][1])
+    columns = []
+    for step, data in slices:
+        scale = step / smallest_step
+        if scale > 1:
+            data = [ d for d in data for _ in xrange(scale) ]
+        columns.append(data[:num_points] + [None] * (num_points - len(data)))
 
+    consolidated = []
+    for point_line in zip(*columns):
+        point_line = [ d for d in point_line if d != None ]
         if point_line:
             average = sum(point_line) / len(point_line)
             consolidated.append([
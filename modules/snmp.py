@@ -27,6 +27,7 @@
 # This module is needed only for SNMP based checks
 
 import subprocess
+import bisect
 
 OID_END              =  0  # Suffix-part of OID that was not specified
 OID_STRING           = -1  # Complete OID as string ".1.3.6.1.4.1.343...."
@@ -136,6 +137,11 @@ def get_snmp_table(hostname, ip, check_type, oid_info, use_snmpwalk_cache):
         max_len = 0
         max_len_col = -1
 
+        # Fetch all columns of the table with one walk instead of one
+        # walk per column, if configured for this host
+        if use_snmp_table_walk(hostname, targetcolumns, use_snmpwalk_cache):
+            prefetch_snmp_table(hostname, ip, check_type, compute_fetch_oid(oid, suboid, ""))
+
         for column in targetcolumns:
             fetchoid = compute_fetch_oid(oid, suboid, column)
 
@@ -239,7 +245,7 @@ def perform_snmpwalk(hostname, ip, check_type, base_oid, fetchoid):
             rows = inline_snmpwalk_on_suboid(hostname, check_type, fetchoid, base_oid,
                                                                   context_name=context_name)
         else:
-            rows = snmpwalk_on_suboid(hostname, ip, fetchoid, context_name=context_name)
+            rows = cached_snmpwalk_on_suboid(hostname, ip, fetchoid, context_name=context_name)
 
         # I've seen a broken device (Mikrotik Router), that broke after an
         # update to RouterOS v6.22. It would return 9 time the same OID when
@@ -259,6 +265,35 @@ def perform_snmpwalk(hostname, ip, check_type, base_oid, fetchoid):
     return rowinfo
 
 
+# Fetching all columns of a table at once is only possible with classic
+# SNMP (not with stored walks) and makes only sense if more than one
+# column needs to be walked.
+def use_snmp_table_walk(hostname, columns, use_snmpwalk_cache):
+    if (has_inline_snmp and use_inline_snmp) or opt_use_snmp_walk or is_usewalk_host(hostname):
+        return False
+
+    num_walked = 0
+    for column in columns:
+        if column in [ OID_END, OID_STRING, OID_BIN, OID_END_BIN, OID_END_OCTET_STRING ]:
+            continue
+        elif is_snmpwalk_cachable(column) and use_snmpwalk_cache:
+            continue # might be taken from the walk cache
+        num_walked += 1
+
+    return num_walked > 1 and is_snmp_table_walk_host(hostname)
+
+
+def prefetch_snmp_table(hostname, ip, check_type, table_oid):
+    if is_snmpv3_host(hostname):
+        snmp_contexts = snmpv3_contexts_of(hostname, check_type)
+    else:
+        snmp_contexts = [None]
+
+    for context_name in snmp_contexts:
+        vverbose("  Walking complete table %s\n" % table_oid)
+        cached_snmpwalk_on_suboid(hostname, ip, table_oid, context_name=context_name)
+
+
 def compute_fetch_oid(oid, suboid, column):
     fetchoid = oid
 
@@ -408,7 +443,7 @@ def get_cached_snmpwalk(hostname, fetchoid):
 
     try:
         vverbose("  Loading %s from walk cache %s\n" % (fetchoid, path))
-        return eval(file(path).read())
+        return read_data_file(path)
     except IOError:
         return None # don't print error when not cached yet
     except:
@@ -423,9 +458,14 @@ def save_snmpwalk_cache(hostname, fetchoid, rowinfo):
     if not os.path.exists(base_dir):
         os.makedirs(base_dir)
     vverbose("  Caching walk of %s\n" % fetchoid)
-    file(base_dir + fetchoid, "w").write("%r\n" % rowinfo)
+    write_data_file(base_dir + fetchoid, rowinfo)
 
 
+# Stored walks are loaded only once per host and kept in g_walk_cache as
+# three parallel lists: the OIDs as tuples of integers (sorted, used for
+# binary search), the OIDs as found in the file and the raw values. This
+# parsed form is also kept as an index file in tmp_dir/snmpwalk_index,
+# so that later runs need not parse the walk again.
 g_walk_cache = {}
 def get_stored_snmpwalk(hostname, oid):
     if oid.startswith("."):
@@ -442,92 +482,89 @@ def get_stored_snmpwalk(hostname, oid):
 
     vverbose("  Loading %s from %s\n" % (oid, path))
 
-    rowinfo = []
+    try:
+        prefix = tuple(map(int, oid_prefix.split(".")))
+    except:
+        raise MKGeneralException("Invalid OID %s" % oid)
 
-    # New implementation: use binary search
-    def to_bin_string(oid):
-        try:
-            return tuple(map(int, oid.strip(".").split(".")))
-        except:
-            raise MKGeneralException("Invalid OID %s" % oid)
+    if hostname in g_walk_cache:
+        oids, oid_texts, values = g_walk_cache[hostname]
+    else:
+        oids, oid_texts, values = load_stored_snmpwalk(hostname, path)
+        g_walk_cache[hostname] = oids, oid_texts, values
 
-    def compare_oids(a, b):
-        aa = to_bin_string(a)
-        bb = to_bin_string(b)
-        if len(aa) <= len(bb) and bb[:len(aa)] == aa:
-            result = 0
-        else:
-            result = cmp(aa, bb)
-        return result
+    rowinfo = []
+    index = bisect.bisect_left(oids, prefix)
+    while index < len(oids) and oids[index][:len(prefix)] == prefix:
+        # With .* only the OIDs below the prefix are used
+        if not dot_star or len(oids[index]) > len(prefix):
+            value = values[index]
+            try:
+                value = agent_simulator_process(value)
+            except:
+                pass # agent simulator missing in precompiled mode
+            rowinfo.append(('.' + oid_texts[index], strip_snmp_value(value)))
+        index += 1
 
-    if hostname in g_walk_cache:
-        lines = g_walk_cache[hostname]
+    if dot_star:
+        return rowinfo[:1]
     else:
-        try:
-            lines = file(path).readlines()
-        except IOError:
-            raise MKSNMPError("No snmpwalk file %s" % path)
-        g_walk_cache[hostname] = lines
-
-    begin = 0
-    end = len(lines)
-    hit = None
-    while end - begin > 0:
-        current = (begin + end) / 2
-        parts = lines[current].split(None, 1)
-        comp = parts[0]
-        hit = compare_oids(oid_prefix, comp)
-        if hit == 0:
-            break
-        elif hit == 1: # we are too low
-            begin = current + 1
-        else:
-            end = current
+        return rowinfo
 
-    if hit != 0:
-        return [] # not found
 
+def load_stored_snmpwalk(hostname, path):
+    try:
+        walk_stat = os.stat(path)
+    except OSError:
+        raise MKSNMPError("No snmpwalk file %s" % path)
 
-    def collect_until(index, direction):
-        rows = []
-        # Handle case, where we run after the end of the lines list
-        if index >= len(lines):
-            if direction > 0:
-                return []
-            else:
-                index -= 1
-        while True:
-            line = lines[index]
-            parts = line.split(None, 1)
-            o = parts[0]
-            if o.startswith('.'):
-                o = o[1:]
-            if o == oid or o.startswith(oid_prefix + "."):
-                if len(parts) > 1:
-                    try:
-                        value = agent_simulator_process(parts[1])
-                    except:
-                        value = parts[1] # agent simulator missing in precompiled mode
-                else:
-                    value = ""
-                # Fix for missing starting oids
-                rows.append(('.'+o, strip_snmp_value(value)))
-                index += direction
-                if index < 0 or index >= len(lines):
-                    break
-            else:
-                break
-        return rows
+    index_path = tmp_dir + "/snmpwalk_index/" + hostname
+    try:
+        mtime, size, oids, oid_texts, values = read_data_file(index_path)
+        if mtime == walk_stat.st_mtime and size == walk_stat.st_size:
+            return oids, oid_texts, values
+    except:
+        pass # no or outdated index
 
+    vverbose("  Creating index of %s\n" % path)
+    try:
+        lines = file(path).readlines()
+    except IOError:
+        raise MKSNMPError("No snmpwalk file %s" % path)
+
+    rows = []
+    for line in lines:
+        parts = line.split(None, 1)
+        if not parts:
+            continue
+        o = parts[0].lstrip(".")
+        try:
+            oid_tuple = tuple(map(int, o.split(".")))
+        except ValueError:
+            if opt_debug:
+                raise MKGeneralException("Invalid OID %s in %s" % (parts[0], path))
+            continue
+        if len(parts) > 1:
+            value = parts[1]
+        else:
+            value = ""
+        rows.append((oid_tuple, o, value))
+    rows.sort()
 
-    rowinfo = collect_until(current, -1)
-    rowinfo.reverse()
-    rowinfo += collect_until(current + 1, 1)
+    oids      = [ r[0] for r in rows ]
+    oid_texts = [ r[1] for r in rows ]
+    values    = [ r[2] for r in rows ]
 
-    if dot_star:
-        return [ rowinfo[0] ]
-    else:
-        return rowinfo
+    try:
+        if not os.path.exists(tmp_dir + "/snmpwalk_index"):
+            os.makedirs(tmp_dir + "/snmpwalk_index")
+        write_data_file(index_path, (walk_stat.st_mtime, walk_stat.st_size, oids, oid_texts, values))
+    except Exception, e:
+        if opt_debug:
+            raise
+        verbose("Cannot write index of SNMP walk to %s: %s\n" % (index_path, e))
+
+    return oids, oid_texts, values
 
 def snmp_decode_string(text):
     encoding = get_snmp_character_encoding(g_hostname)
@@ -540,6 +577,25 @@ def snmp_decode_string(text):
         except:
             return text.decode('latin1')
 
+# Subtrees that have already been walked during this run via classic SNMP.
+# The key is the pair of hostname and SNMP context, the value is a dict from
+# the walked OID to the rows of the walk. A walk of an OID below an already
+# walked subtree is answered from that subtree, so that different checks
+# and columns of the same table need only one snmpwalk process.
+g_snmp_subtree_cache = {}
+
+def cached_snmpwalk_on_suboid(hostname, ip, oid, context_name = None):
+    walked = g_snmp_subtree_cache.setdefault((hostname, context_name), {})
+    for walked_oid, rows in walked.items():
+        if oid == walked_oid or oid.startswith(walked_oid + "."):
+            vverbose("   Using rows of already walked subtree %s\n" % walked_oid)
+            prefix = oid + "."
+            return [ (o, value) for o, value in rows if o == oid or o.startswith(prefix) ]
+
+    rows = snmpwalk_on_suboid(hostname, ip, oid, context_name=context_name)
+    walked[oid] = rows
+    return rows
+
 #   .--Classic SNMP--------------------------------------------------------.
 #   |        ____ _               _        ____  _   _ __  __ ____         |
 #   |       / ___| | __ _ ___ ___(_) ___  / ___|| \ | |  \/  |  _ \        |
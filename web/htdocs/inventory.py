@@ -24,7 +24,7 @@
 # to the Free Software Foundation, Inc., 51 Franklin St,  Fifth Floor,
 # Boston, MA 02110-1301 USA.
 
-import defaults, re, os
+import defaults, re, os, time
 
 # Load data of a host, cache it in the current HTTP request
 def host(hostname):
@@ -65,16 +65,79 @@ def get_host_history(hostname):
     except:
         return [] # No inventory for this host
 
+    history += [ ts for ts, is_delta in get_archive_entries(hostname) ]
+    history.sort()
+    history.reverse()
+    return history
+
+# Archived trees are either stored completely in the file TIMESTAMP or
+# as delta to the next newer tree in the file TIMESTAMP.delta (see
+# modules/inventory.py). Returns pairs of timestamp and a flag whether
+# or not the tree is stored as delta, newest first.
+def get_archive_entries(hostname):
     arcdir = defaults.var_dir + "/inventory_archive/" + hostname
+    entries = []
     if os.path.exists(arcdir):
-        for ts in os.listdir(arcdir):
+        for filename in os.listdir(arcdir):
             try:
-                history.append(int(ts))
+                if filename.endswith(".delta"):
+                    entries.append((int(filename[:-6]), True))
+                else:
+                    entries.append((int(filename), False))
             except:
                 pass
-    history.sort()
-    history.reverse()
-    return history
+    entries.sort(reverse=True)
+    return entries
+
+def load_archive_entry(hostname, tree, timestamp, is_delta):
+    path = defaults.var_dir + "/inventory_archive/" + hostname + "/%d" % timestamp
+    if is_delta:
+        return apply_delta(tree, eval(file(path + ".delta").read()))
+    else:
+        return eval(file(path).read())
+
+# Restores the old tree from the newer one. Unchanged nodes are shared
+# between both trees.
+def apply_delta(tree, delta):
+    if delta[0] == "set":
+        return delta[1]
+
+    elif delta[0] == "dict":
+        tree = dict(tree)
+        for key, subdelta in delta[1].items():
+            if subdelta[0] == "del":
+                del tree[key]
+            else:
+                tree[key] = apply_delta(tree.get(key), subdelta)
+        return tree
+
+    else:
+        new_tree = []
+        for part in delta[1]:
+            if part[0] == "r":
+                new_tree += tree[part[1]:part[2]]
+            else:
+                new_tree += part[1]
+        return new_tree
+
+# Returns pairs of timestamp and tree of all inventory snapshots
+# of a host, newest first.
+def load_host_history(hostname):
+    history = get_host_history(hostname)
+    if not history:
+        return []
+
+    tree = host(hostname)
+    trees = [ (history[0], tree) ]
+    for timestamp, is_delta in get_archive_entries(hostname):
+        try:
+            tree = load_archive_entry(hostname, tree, timestamp, is_delta)
+        except Exception, e:
+            raise MKGeneralException(_("Cannot restore the inventory of %s from %s: %s") %
+                                       (hostname, time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                time.localtime(timestamp)), e))
+        trees.append((timestamp, tree))
+    return trees
 
 # Timestamp is timestamp of the younger of both trees. For the oldest
 # tree we will just return the complete tree - without any delta
@@ -104,12 +167,31 @@ def load_historic_host(hostname, timestamp):
     if int(os.stat(path).st_mtime) == timestamp:
         return host(hostname)
 
-    try:
-        path = defaults.var_dir + "/inventory_archive/" + hostname + "/%d" % timestamp
-        return eval(file(path).read())
-    except:
+    entries = get_archive_entries(hostname)
+    for nr, (ts, is_delta) in enumerate(entries):
+        if ts == timestamp:
+            break
+    else:
         return {}
 
+    try:
+        # Begin with the next complete tree, either archived or the current one
+        start = nr
+        while start >= 0 and entries[start][1]:
+            start -= 1
+        if start < 0:
+            tree = host(hostname)
+        else:
+            tree = load_archive_entry(hostname, None, entries[start][0], False)
+
+        for ts, is_delta in entries[start+1:nr+1]:
+            tree = load_archive_entry(hostname, tree, ts, is_delta)
+        return tree
+    except Exception, e:
+        raise MKGeneralException(_("Cannot restore the inventory of %s from %s: %s") %
+                                   (hostname, time.strftime("%Y-%m-%d %H:%M:%S",
+                                                            time.localtime(timestamp)), e))
+
 
 
 # Example for the paths:
@@ -1083,10 +1083,9 @@ def inv_history_table(columns, add_headers, only_sites, limit, filters):
 
 def create_hist_rows(hostname, columns):
     hist_tree = None
-    # Iterate over all known historic inventory states - from new to old
-    for timestamp in inventory.get_host_history(hostname)[::-1]:
-        old_hist_tree = hist_tree
-        hist_tree = inventory.load_historic_host(hostname, timestamp)
+    # Iterate over all known historic inventory states - from old to new
+    for timestamp, tree in inventory.load_host_history(hostname)[::-1]:
+        old_hist_tree, hist_tree = hist_tree, tree
         removed, new, changed, delta_tree = inventory.compare_trees(old_hist_tree, hist_tree)
         newrow = {
             "invhist_time"    : timestamp,
@@ -962,6 +962,20 @@ register_configvar(group,
     need_restart = True)
 
 
+register_configvar(group,
+    "keepalive_fork_workers",
+    Checkbox(title = _("Forked check helpers in keepalive mode"),
+             label = _("Execute each check in a forked worker process"),
+             help = _("When using the Check_MK Micro Core the Check_MK check helpers keep "
+                      "running and execute one check after another. If you enable this option "
+                      "each helper loads the configuration only once and executes every check "
+                      "in a worker process that has been forked off in advance. Such a worker "
+                      "shares the loaded configuration with its helper and always starts with "
+                      "a clean state. This makes the helpers immune against memory leaks and "
+                      "against check plugins that leave global data behind.")),
+    need_restart = True)
+
+
 register_configvar(group,
     "simulation_mode",
     Checkbox(title = _("Simulation mode"),
@@ -1995,6 +2009,16 @@ register_rule(group,
              "bulk walk but behave very bad when it is used. When you want to enable v2c while not using "
              "bulk walk, please use the rule set snmpv2c_hosts instead."))
 
+register_rule(group,
+    "snmp_table_walk_hosts",
+    title = _("Hosts using one SNMP walk per table"),
+    help = _("Per default Check_MK fetches each column of an SNMP table with a separate walk. "
+             "With classic SNMP (not Inline SNMP) each walk is a separate process. For hosts "
+             "configured with this ruleset all columns of a table are fetched with one single "
+             "walk of the complete table. This saves many processes on devices with large tables "
+             "like switches with many ports - especially when used together with SNMP bulk walk. "
+             "Please note that also the columns of the table not needed by the checks are fetched."))
+
 register_rule(group,
     "snmp_without_sys_descr",
     title = _("Hosts without system description OID"),
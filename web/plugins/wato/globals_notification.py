@@ -86,6 +86,19 @@ register_configvar(group,
     domain = "check_mk",
     need_restart = True)
 
+register_configvar(group,
+    "notification_bulk_spoolfile",
+    Checkbox(
+        title = _("Store bulk notifications in one file per bulk"),
+        label = _("Append bulked notifications to a single spool file"),
+        help = _("Per default each notification that is being postponed for a bulk notification "
+                 "is stored in a separate file. If you enable this option, then all notifications "
+                 "of a bulk are appended to one single file instead. This reduces the number of "
+                 "files being created during large outages."),
+        default_value = False,
+    ),
+    domain = "check_mk")
+
 register_configvar(group,
     "notification_plugin_timeout",
     Age(
@@ -96,6 +109,35 @@ register_configvar(group,
     ),
     domain = "check_mk")
 
+register_configvar(group,
+    "notification_plugin_max_concurrent",
+    Integer(
+        title = _("Maximum number of concurrent notification plugins"),
+        help = _("Rule based notifications execute the notification plugins in parallel, so that "
+                 "a slow plugin does not delay the notifications via other plugins. This setting "
+                 "limits the number of plugins being executed at the same time. Further "
+                 "notifications are queued. A limit for a single plugin can be set in "
+                 "<tt>main.mk</tt> with <tt>notification_plugin_concurrency</tt>, e.g. "
+                 "<tt>{ \"sms\" : 1 }</tt>."),
+        default_value = 10,
+        minvalue = 1,
+    ),
+    domain = "check_mk")
+
+register_configvar(group,
+    "notification_plugin_retries",
+    Integer(
+        title = _("Retries of failed notification plugins"),
+        help = _("If a notification plugin exits with code 1 (temporary error), then the "
+                 "notification is retried this number of times. The first retry is done after "
+                 "10 seconds, each further retry waits twice as long as the previous one. "
+                 "Retries are only done in keepalive mode (Check_MK Micro Core). "
+                 "Asynchronous delivery via the notification spooler has its own retry."),
+        default_value = 2,
+        minvalue = 0,
+    ),
+    domain = "check_mk")
+
 register_configvar(group,
     "notification_logging",
     Transform(